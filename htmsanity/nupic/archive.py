@@ -0,0 +1,141 @@
+import cPickle as pickle
+import mmap
+import os
+import struct
+
+# Each index entry: chunk number, offset within the chunk, record length.
+INDEX_ENTRY = struct.Struct('<IQI')
+
+# Increment this when the layout of the archive or its header changes.
+FORMAT_VERSION = 1
+
+
+class SnapshotArchive(object):
+    """
+    Append-only on-disk storage for journal snapshots.
+
+    Snapshots are pickled into chunk files. When a chunk reaches chunkBytes,
+    a new chunk is started. An index file holds one fixed-size entry per
+    snapshot id, so any snapshot can be found without scanning the chunks.
+    A header file describes the whole recording (see writeHeader).
+
+    Reads go through memory maps of the index and of the chunks, which are
+    created lazily and remapped as the files grow. Because of this, a process
+    can read snapshots without holding them in memory.
+    """
+    def __init__(self, directory, chunkBytes=64 * 1024 * 1024, readOnly=False):
+        self.directory = directory
+        self.chunkBytes = chunkBytes
+        self.readOnly = readOnly
+
+        if not readOnly and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        indexPath = os.path.join(directory, 'index')
+        if readOnly:
+            self.indexFile = open(indexPath, 'rb')
+        else:
+            self.indexFile = open(indexPath, 'a+b')
+        self.indexFile.seek(0, os.SEEK_END)
+        self.nSnapshots = self.indexFile.tell() // INDEX_ENTRY.size
+        self.indexMap = None
+
+        self.chunkMaps = {}
+        self.chunkFile = None
+        self.chunkNumber = 0
+        if self.nSnapshots > 0:
+            self.chunkNumber, _, _ = self.readIndexEntry(self.nSnapshots - 1)
+
+    def __len__(self):
+        return self.nSnapshots
+
+    def chunkPath(self, chunkNumber):
+        return os.path.join(self.directory, 'chunk-%06d' % chunkNumber)
+
+    def append(self, record):
+        """
+        Write a snapshot record. Returns its snapshot id within the archive.
+        """
+        assert not self.readOnly
+        if self.chunkFile is None:
+            self.chunkFile = open(self.chunkPath(self.chunkNumber), 'ab')
+        elif self.chunkFile.tell() >= self.chunkBytes:
+            self.chunkFile.close()
+            self.chunkNumber += 1
+            self.chunkFile = open(self.chunkPath(self.chunkNumber), 'ab')
+
+        data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        offset = self.chunkFile.tell()
+        self.chunkFile.write(data)
+        self.chunkFile.flush()
+
+        self.indexFile.write(INDEX_ENTRY.pack(self.chunkNumber, offset,
+                                              len(data)))
+        self.indexFile.flush()
+
+        snapshotId = self.nSnapshots
+        self.nSnapshots += 1
+        return snapshotId
+
+    def headerPath(self):
+        return os.path.join(self.directory, 'header')
+
+    def writeHeader(self, header):
+        """
+        Store a dict describing the recording, e.g. the network shape and
+        capture options. The previous header is replaced atomically, so a
+        reader never sees a partially written header.
+        """
+        assert not self.readOnly
+        header = dict(header)
+        header['format-version'] = FORMAT_VERSION
+        tmpPath = self.headerPath() + '.tmp'
+        with open(tmpPath, 'wb') as f:
+            pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmpPath, self.headerPath())
+
+    def readHeader(self):
+        with open(self.headerPath(), 'rb') as f:
+            header = pickle.load(f)
+        if header['format-version'] != FORMAT_VERSION:
+            raise ValueError("Unsupported journal format version %s in %s" %
+                             (header['format-version'], self.directory))
+        return header
+
+    def readIndexEntry(self, snapshotId):
+        end = (snapshotId + 1) * INDEX_ENTRY.size
+        if self.indexMap is None or len(self.indexMap) < end:
+            self.indexMap = _remap(self.indexMap, self.indexFile)
+        return INDEX_ENTRY.unpack_from(self.indexMap,
+                                       snapshotId * INDEX_ENTRY.size)
+
+    def __getitem__(self, snapshotId):
+        if snapshotId < 0 or snapshotId >= self.nSnapshots:
+            raise IndexError(snapshotId)
+
+        chunkNumber, offset, length = self.readIndexEntry(snapshotId)
+        chunkMap = self.chunkMaps.get(chunkNumber)
+        if chunkMap is None or len(chunkMap) < offset + length:
+            with open(self.chunkPath(chunkNumber), 'rb') as f:
+                chunkMap = _remap(chunkMap, f)
+            self.chunkMaps[chunkNumber] = chunkMap
+
+        return pickle.loads(chunkMap[offset:offset + length])
+
+    def close(self):
+        for chunkMap in self.chunkMaps.values():
+            chunkMap.close()
+        self.chunkMaps.clear()
+        if self.indexMap is not None:
+            self.indexMap.close()
+            self.indexMap = None
+        if self.chunkFile is not None:
+            self.chunkFile.close()
+            self.chunkFile = None
+        self.indexFile.close()
+
+
+def _remap(prevMap, f):
+    if prevMap is not None:
+        prevMap.close()
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
@@ -0,0 +1,78 @@
+import Queue
+import threading
+import traceback
+
+
+class CaptureWorker(object):
+    """
+    Processes captured timesteps on a background thread, in order.
+
+    The queue is bounded. whenFull decides what happens when the model
+    produces timesteps faster than the worker can process them:
+     - 'block': The model thread waits until there's room in the queue.
+     - 'drop': Timesteps are skipped until there's room in the queue.
+     - 'decimate': Only every Nth timestep is captured. N doubles whenever the
+       queue is full and halves whenever the worker has caught up.
+
+    Call shouldCapture before doing the work of capturing a timestep, then
+    submit the capture.
+    """
+    def __init__(self, process, queueSize=16, whenFull='block'):
+        assert whenFull in ('block', 'drop', 'decimate')
+        self.process = process
+        self.queue = Queue.Queue(queueSize)
+        self.whenFull = whenFull
+        self.interval = 1
+        self.nSinceCapture = 0
+        self.nSkipped = 0
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def configure(self, queueSize, whenFull):
+        assert whenFull in ('block', 'drop', 'decimate')
+        with self.queue.mutex:
+            self.queue.maxsize = queueSize
+        self.whenFull = whenFull
+        if whenFull != 'decimate':
+            self.interval = 1
+
+    def shouldCapture(self):
+        if self.whenFull == 'block':
+            return True
+
+        if self.whenFull == 'decimate':
+            if self.queue.empty() and self.interval > 1:
+                self.interval //= 2
+
+            self.nSinceCapture += 1
+            if self.nSinceCapture < self.interval:
+                self.nSkipped += 1
+                return False
+            self.nSinceCapture = 0
+
+        if self.queue.full():
+            if self.whenFull == 'decimate':
+                self.interval *= 2
+            self.nSkipped += 1
+            return False
+
+        return True
+
+    def submit(self, capture):
+        self.queue.put(capture)
+
+    def join(self):
+        """Wait until every submitted capture has been processed."""
+        self.queue.join()
+
+    def run(self):
+        while True:
+            capture = self.queue.get()
+            try:
+                self.process(capture)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self.queue.task_done()
@@ -0,0 +1,490 @@
+from abc import ABCMeta, abstractmethod
+import functools
+import itertools
+import operator
+import time
+
+import numpy as np
+from nupic.bindings.math import GetNTAReal
+
+from lazysegments import LazySegments
+from sdr import SDR
+
+
+# The states of a listed synapse, in the order that ClassifiedSegments
+# numbers them. These are the keys of each source's synapse lists in a
+# segment summary.
+SYNAPSE_STATES = ('active', 'inactive-syn', 'disconnected')
+
+
+class SynapseBackend(object):
+    """
+    Abstract base class. Reads a model's segments and synapses into flat
+    arrays for extractSegments.
+
+    cellIds are the keys of each column's cells in a segsByColCell dict, and
+    connectedPermanence is the model's connected permanence.
+    """
+    __metaclass__ = ABCMeta
+
+    def __init__(self, cellIds, connectedPermanence):
+        self.cellIds = cellIds
+        self.connectedPermanence = connectedPermanence
+
+    @abstractmethod
+    def segmentsForColumns(self, columns):
+        """
+        Find the segments of every cell of the columns.
+
+        Returns
+        -------
+        (list, list)
+          The number of segments on each cell of the columns, in order, and
+          the segments in that same order.
+        """
+
+    @abstractmethod
+    def gatherSynapses(self, segments):
+        """
+        Read the synapses of the segments that segmentsForColumns found.
+
+        Returns
+        -------
+        (numpy.ndarray, numpy.ndarray, numpy.ndarray)
+          The index in segments of each synapse's segment, in ascending
+          order, and the synapses' presynaptic cells and permanences.
+        """
+
+
+class ConnectionsBackend(SynapseBackend):
+    """
+    Read the segments of a Connections. presynapticOffset is added to every
+    presynaptic cell.
+    """
+    def __init__(self, connections, cellsPerColumn, connectedPermanence,
+                 presynapticOffset=0):
+        super(ConnectionsBackend, self).__init__(range(cellsPerColumn),
+                                                 connectedPermanence)
+        self.connections = connections
+        self.cellsPerColumn = cellsPerColumn
+        self.presynapticOffset = presynapticOffset
+
+    def segmentsForColumns(self, columns):
+        return segmentsForColumns(self.connections.segmentsForCell,
+                                  self.cellsPerColumn, columns)
+
+    def gatherSynapses(self, segments):
+        # The Connections has no bulk accessor, so each synapse is still read
+        # with a call to dataForSynapse. Keep the rest of the loop minimal.
+        dataForSynapse = self.connections.dataForSynapse
+        synapsesForSegment = self.connections.synapsesForSegment
+        getPresynapticCell = operator.attrgetter('presynapticCell')
+        getPermanence = operator.attrgetter('permanence')
+        nSynapsesBySegment = []
+        presynapticCells = []
+        permanences = []
+        for seg in segments:
+            synapses = map(dataForSynapse, synapsesForSegment(seg))
+            presynapticCells.extend(map(getPresynapticCell, synapses))
+            permanences.extend(map(getPermanence, synapses))
+            nSynapsesBySegment.append(len(synapses))
+
+        return (segmentIdsFromCounts(nSynapsesBySegment),
+                (np.array(presynapticCells, dtype=np.int64) +
+                 self.presynapticOffset),
+                np.array(permanences, dtype=np.float32))
+
+
+class SegmentSparseMatrixBackend(SynapseBackend):
+    """
+    Read the segments of a SegmentSparseMatrix. Each segment is a row of its
+    matrix.
+    """
+    def __init__(self, connections, cellsPerColumn, connectedPermanence):
+        super(SegmentSparseMatrixBackend, self).__init__(range(cellsPerColumn),
+                                                         connectedPermanence)
+        self.connections = connections
+        self.cellsPerColumn = cellsPerColumn
+
+    def segmentsForColumns(self, columns):
+        return segmentsForColumns(self.connections.getSegmentsForCell,
+                                  self.cellsPerColumn, columns)
+
+    def gatherSynapses(self, segments):
+        """
+        When the segments are a large part of the matrix, all of its nonzeros
+        are fetched in one call and the segments' rows are selected from
+        them. Otherwise each segment's row is fetched as nonzeros. Either way
+        no dense rows are made.
+        """
+        matrix = self.connections.matrix
+        segments = np.asarray(segments, dtype=np.int64)
+        if len(segments) * 8 >= matrix.nRows():
+            rows, presynapticCells, permanences = matrix.getAllNonZeros(True)
+            segmentIndex = np.full(matrix.nRows(), -1, dtype=np.int64)
+            segmentIndex[segments] = np.arange(len(segments))
+            segmentIds = segmentIndex[rows]
+            selected = segmentIds >= 0
+            # The nonzeros are sorted by row. Sort them into the order of
+            # segments, keeping each row's nonzeros in order.
+            order = np.argsort(segmentIds[selected], kind='mergesort')
+            return (segmentIds[selected][order],
+                    presynapticCells[selected][order],
+                    permanences[selected][order])
+
+        nSynapsesBySegment = []
+        presynapticCells = []
+        permanences = [np.zeros(0, dtype=np.float32)]
+        for seg in segments.tolist():
+            rowPresynapticCells, rowPermanences = matrix.rowNonZeros(seg)
+            presynapticCells.extend(rowPresynapticCells)
+            permanences.append(rowPermanences)
+            nSynapsesBySegment.append(len(rowPresynapticCells))
+
+        return (segmentIdsFromCounts(nSynapsesBySegment),
+                np.array(presynapticCells, dtype=np.int64),
+                np.concatenate(permanences))
+
+
+class TPBackend(SynapseBackend):
+    """
+    Read the segments of a legacy TP. A segment is a (column, cell, index)
+    tuple, and the presynaptic cells are the TP's own cells.
+    """
+    def __init__(self, tp):
+        super(TPBackend, self).__init__(range(tp.cellsPerColumn),
+                                        tp.connectedPerm)
+        self.tp = tp
+
+    def segmentsForColumns(self, columns):
+        nSegmentsByCell = []
+        segments = []
+        for col in columns:
+            for cell in xrange(self.tp.cellsPerColumn):
+                nSegments = self.tp.getNumSegmentsInCell(col, cell)
+                segments.extend((col, cell, segIdx)
+                                for segIdx in xrange(nSegments))
+                nSegmentsByCell.append(nSegments)
+        return nSegmentsByCell, segments
+
+    def gatherSynapses(self, segments):
+        # The TP has no bulk accessor, so getSegmentOnCell is called once
+        # per segment. Its synapses are [column, cell, permanence] lists.
+        nSynapsesBySegment = []
+        synapses = []
+        for col, cell, segIdx in segments:
+            # The first item describes the segment.
+            segSynapses = self.tp.getSegmentOnCell(col, cell, segIdx)[1:]
+            synapses.extend(segSynapses)
+            nSynapsesBySegment.append(len(segSynapses))
+
+        # The TP's permanences are kept as float64, so they're compared and
+        # listed exactly as the TP stores them.
+        synapses = np.fromiter(itertools.chain.from_iterable(synapses),
+                               dtype=np.float64,
+                               count=3 * len(synapses)).reshape(-1, 3)
+        presynapticCells = (synapses[:, 0].astype(np.int64) *
+                            self.tp.cellsPerColumn +
+                            synapses[:, 1].astype(np.int64))
+        return (segmentIdsFromCounts(nSynapsesBySegment), presynapticCells,
+                synapses[:, 2])
+
+
+class PotentialPools(object):
+    """
+    A spatial pooler's potential pools, which don't change after it's
+    initialized, in CSR form. Column c's potential inputs are
+    inputBits[offsets[c]:offsets[c + 1]], in order.
+    """
+    def __init__(self, sp):
+        synapsePotentials = np.zeros(sp.getNumInputs(), dtype='uint32')
+        inputBits = []
+        for column in xrange(sp.getNumColumns()):
+            sp.getPotential(column, synapsePotentials)
+            inputBits.append(np.flatnonzero(synapsePotentials).astype(np.uint32))
+
+        self.offsets = np.zeros(sp.getNumColumns() + 1, dtype=np.int64)
+        np.cumsum([len(bits) for bits in inputBits], out=self.offsets[1:])
+        self.inputBits = np.concatenate(inputBits)
+
+    @property
+    def nbytes(self):
+        return self.offsets.nbytes + self.inputBits.nbytes
+
+    def inputsForColumn(self, column):
+        return self.inputBits[self.offsets[column]:self.offsets[column + 1]]
+
+    def select(self, columns):
+        """
+        Returns the row within columns and the input bit of each potential
+        synapse of the columns, grouped by column.
+        """
+        starts = self.offsets[columns]
+        lengths = self.offsets[columns + 1] - starts
+        rows = np.repeat(np.arange(len(columns)), lengths)
+        positions = (np.arange(lengths.sum()) +
+                     np.repeat(starts - (np.cumsum(lengths) - lengths), lengths))
+        return rows, self.inputBits[positions]
+
+
+class SpatialPoolerBackend(SynapseBackend):
+    """
+    Read the proximal segments of a spatial pooler. Each column has one
+    segment, on cell -1, and its synapses are its potential pool.
+
+    Whole permanence vectors are read, a block of columns at a time.
+    blockBytes limits the size of the block.
+    """
+    def __init__(self, sp, potentialPools=None, blockBytes=16 * 1024 * 1024):
+        super(SpatialPoolerBackend, self).__init__([-1],
+                                                   sp.getSynPermConnected())
+        if potentialPools is None:
+            potentialPools = PotentialPools(sp)
+        self.sp = sp
+        self.potentialPools = potentialPools
+        self.blockBytes = blockBytes
+
+    def segmentsForColumns(self, columns):
+        return [1] * len(columns), columns
+
+    def gatherSynapses(self, segments):
+        sp = self.sp
+        columns = np.asarray(segments, dtype=np.int64)
+        rows, inputBits = self.potentialPools.select(columns)
+
+        nInputs = sp.getNumInputs()
+        # Don't allocate more rows than there are columns, e.g. for a small
+        # region of interest.
+        blockSize = max(1, min(self.blockBytes // (nInputs * 4),
+                               len(columns)))
+        synapsePermanences = np.zeros((blockSize, nInputs),
+                                      dtype=GetNTAReal())
+        permanences = np.zeros(len(inputBits), dtype=GetNTAReal())
+        for blockStart in xrange(0, len(columns), blockSize):
+            blockColumns = columns[blockStart:blockStart + blockSize]
+            for i, column in enumerate(blockColumns.tolist()):
+                sp.getPermanence(column, synapsePermanences[i])
+            start, stop = np.searchsorted(
+                rows, [blockStart, blockStart + len(blockColumns)])
+            permanences[start:stop] = synapsePermanences[
+                rows[start:stop] - blockStart, inputBits[start:stop]]
+
+        return rows, inputBits, permanences
+
+
+def segmentsForColumns(segmentsForCell, cellsPerColumn, columns):
+    """
+    Returns the number of segments on each cell of the columns, and the
+    segments in that order.
+    """
+    nSegmentsByCell = []
+    segments = []
+    for col in columns:
+        for cell in xrange(col * cellsPerColumn, (col + 1) * cellsPerColumn):
+            segs = segmentsForCell(cell)
+            segments.extend(segs)
+            nSegmentsByCell.append(len(segs))
+    return nSegmentsByCell, segments
+
+
+def segmentIdsFromCounts(nSynapsesBySegment):
+    return np.repeat(np.arange(len(nSynapsesBySegment), dtype=np.int64),
+                     nSynapsesBySegment)
+
+
+def countBySegment(mask, segmentStarts):
+    """
+    Count the true values of mask in each segment's slice.
+    """
+    # reduceat needs each start to be a valid index, and it returns the
+    # element at the start for an empty slice rather than 0.
+    counts = np.add.reduceat(np.append(mask, False).astype(np.int32),
+                             segmentStarts[:-1])
+    counts[segmentStarts[:-1] == segmentStarts[1:]] = 0
+    return counts
+
+
+class ClassifiedSegments(object):
+    """
+    The summaries of some segments, stored as flat arrays.
+
+    Every synapse is classified when this is made, with masks over all of the
+    segments, and the counts are computed with reduceat. Only the synapses
+    that will be listed are kept, grouped by segment, source and state, so a
+    segment's synapse lists are slices of sourceBits and permanences.
+    """
+    def __init__(self, nSegments, segmentIds, presynapticCells, permanences,
+                 connectedPermanence, activeBits, onlyActiveSynapses,
+                 onlyConnectedSynapses, inputsAndWidths):
+        """
+        segmentIds says which of the nSegments segments each synapse belongs
+        to, and must be in ascending order.
+        """
+        offsets = np.cumsum([0] + [width for _, width in inputsAndWidths])
+        segmentIds = np.asarray(segmentIds, dtype=np.int64)
+        presynapticCells = np.asarray(presynapticCells, dtype=np.int64)
+        # Keep the permanences' precision, so they're compared and listed
+        # exactly as the model stores them.
+        permanences = np.asarray(permanences)
+
+        # Synapses beyond the last input aren't counted.
+        inRange = (presynapticCells >= 0) & (presynapticCells < offsets[-1])
+        if not inRange.all():
+            segmentIds = segmentIds[inRange]
+            presynapticCells = presynapticCells[inRange]
+            permanences = permanences[inRange]
+
+        segmentStarts = np.searchsorted(segmentIds, np.arange(nSegments + 1))
+        connected = permanences >= connectedPermanence
+        activeMask = np.zeros(offsets[-1], dtype=bool)
+        activeBits = SDR(activeBits).indices
+        activeMask[activeBits[activeBits < offsets[-1]]] = True
+        active = activeMask[presynapticCells]
+        # nConnectedActive, nConnectedTotal, nDisconnectedActive,
+        # nDisconnectedTotal
+        self.counts = np.column_stack([
+            countBySegment(active & connected, segmentStarts),
+            countBySegment(connected, segmentStarts),
+            countBySegment(active & ~connected, segmentStarts),
+            countBySegment(~connected, segmentStarts),
+        ])
+
+        # Each synapse's index in SYNAPSE_STATES, or -1 to leave it out. With
+        # onlyActiveSynapses, only active synapses are listed, connected or
+        # not.
+        states = np.full(len(permanences), -1, dtype=np.int64)
+        states[active & connected] = 0
+        if not onlyActiveSynapses:
+            states[~active & connected] = 1
+        if not onlyConnectedSynapses:
+            if onlyActiveSynapses:
+                states[active & ~connected] = 2
+            else:
+                states[~connected] = 2
+
+        # Only sort the synapses that are listed, grouping them by segment,
+        # source and state, and sorting each group by presynaptic cell.
+        included = states >= 0
+        presynapticCells = presynapticCells[included]
+        sources = np.searchsorted(offsets, presynapticCells, side='right') - 1
+        groups = ((segmentIds[included] * len(inputsAndWidths) + sources) *
+                  len(SYNAPSE_STATES) + states[included])
+        order = np.argsort(groups * offsets[-1] + presynapticCells)
+        self.groupStarts = np.searchsorted(
+            groups[order],
+            np.arange(nSegments * len(inputsAndWidths) *
+                      len(SYNAPSE_STATES) + 1))
+        self.sourceBits = (presynapticCells -
+                           offsets[sources])[order].astype(np.uint32)
+        self.permanences = permanences[included][order]
+        self.sourcePaths = [sourcePath for sourcePath, _ in inputsAndWidths]
+
+    @property
+    def nbytes(self):
+        return (self.counts.nbytes + self.groupStarts.nbytes +
+                self.sourceBits.nbytes + self.permanences.nbytes)
+
+    def summaries(self, start, stop):
+        """
+        Returns a list with the summaries of segments start to stop.
+        """
+        groupsPerSegment = len(self.sourcePaths) * len(SYNAPSE_STATES)
+        groupStarts = self.groupStarts[start * groupsPerSegment:
+                                       stop * groupsPerSegment + 1]
+        first, last = groupStarts[0], groupStarts[-1]
+        # Convert through int64 so that Python 2 gives ints, not longs.
+        synapses = zip(self.sourceBits[first:last].astype(np.int64).tolist(),
+                       self.permanences[first:last].tolist())
+        groupStarts = (groupStarts - first).tolist()
+
+        summaries = []
+        group = 0
+        for (nConnectedActive, nConnectedTotal, nDisconnectedActive,
+             nDisconnectedTotal) in self.counts[start:stop].tolist():
+            synapsesBySource = {}
+            for sourcePath in self.sourcePaths:
+                synapsesByState = {}
+                for state in SYNAPSE_STATES:
+                    synapsesByState[state] = synapses[groupStarts[group]:
+                                                      groupStarts[group + 1]]
+                    group += 1
+                synapsesBySource[sourcePath] = synapsesByState
+            summaries.append({
+                "synapses": synapsesBySource,
+                "nConnectedActive": nConnectedActive,
+                "nConnectedTotal": nConnectedTotal,
+                "nDisconnectedActive": nDisconnectedActive,
+                "nDisconnectedTotal": nDisconnectedTotal,
+            })
+
+        return summaries
+
+
+def segmentsByColumnCell(columns, cellIds, nSegmentsByCell, summaries):
+    """
+    Arrange a flat list of segment summaries into a segsByColCell dict.
+    nSegmentsByCell has an entry for each cell of each column, in order.
+    """
+    segsByColCell = {}
+    i = 0
+    seg = 0
+    for col in columns:
+        segsByColCell[col] = {}
+        for cell in cellIds:
+            segsByColCell[col][cell] = summaries[seg:seg + nSegmentsByCell[i]]
+            seg += nSegmentsByCell[i]
+            i += 1
+
+    return segsByColCell
+
+
+def extractSegments(backend, columns, activeBits, onlyActiveSynapses,
+                    onlyConnectedSynapses, inputsAndWidths, lazy=False):
+    """
+    Summarize the segments of some columns, reading them with a
+    SynapseBackend.
+
+    Returns a segsByColCell dict, or if lazy is set, a LazySegments that
+    builds each column's summaries the first time it's looked up. A
+    LazySegments only copies the synapses here. It classifies them later.
+    """
+    columns = np.unique(np.fromiter(columns, dtype=np.int64))
+    nSegmentsByCell, segments = backend.segmentsForColumns(columns.tolist())
+    segmentIds, presynapticCells, permanences = backend.gatherSynapses(
+        segments)
+    # Copy the active bits too, since the model may reuse its array.
+    activeBits = SDR(activeBits)
+    classify = functools.partial(ClassifiedSegments, len(segments),
+                                 segmentIds, presynapticCells, permanences,
+                                 backend.connectedPermanence, activeBits,
+                                 onlyActiveSynapses, onlyConnectedSynapses,
+                                 inputsAndWidths)
+
+    if lazy:
+        return LazySegments(columns, backend.cellIds, nSegmentsByCell,
+                            classify)
+    return segmentsByColumnCell(columns.tolist(), backend.cellIds,
+                                nSegmentsByCell,
+                                classify().summaries(0, len(segments)))
+
+
+def benchmarkBackends(backendsByName, columns, activeBits, inputsAndWidths,
+                      onlyActiveSynapses=False, onlyConnectedSynapses=False,
+                      repeat=3):
+    """
+    Time extractSegments with each backend, for comparing backends that read
+    the same model.
+
+    Returns the best of repeat times, in seconds, by backend name.
+    """
+    columns = list(columns)
+    timesByName = {}
+    for name, backend in backendsByName.items():
+        times = []
+        for _ in xrange(repeat):
+            start = time.time()
+            extractSegments(backend, columns, activeBits, onlyActiveSynapses,
+                            onlyConnectedSynapses, inputsAndWidths)
+            times.append(time.time() - start)
+        timesByName[name] = min(times)
+    return timesByName
@@ -0,0 +1,224 @@
+import bisect
+import collections
+
+import numpy as np
+
+from nupic.bindings.algorithms import ConnectionsEventHandler
+
+from snapshots import SnapshotUnavailable
+
+
+SegmentVersion = collections.namedtuple(
+    'SegmentVersion', ['cell', 'ordinal', 'presynapticCells', 'permanences'])
+
+SynapseData = collections.namedtuple(
+    'SynapseData', ['presynapticCell', 'permanence'])
+
+
+class SegmentVersions(object):
+    """
+    The versions of a Connections' segments, by timestep.
+
+    A segment only gets a new version on the timesteps that changed it. A
+    version of None means the segment was destroyed. Versions older than
+    firstTimestep have been discarded.
+    """
+    def __init__(self, firstTimestep):
+        self.firstTimestep = firstTimestep
+        # segment -> ([timestep, ...], [SegmentVersion or None, ...])
+        self.versionsBySegment = {}
+        self.segmentsByCell = collections.defaultdict(set)
+        # timestep -> the segments that got a version on that timestep
+        self.segmentsByTimestep = collections.defaultdict(list)
+
+    def record(self, timestep, segment, version):
+        timesteps, versions = self.versionsBySegment.setdefault(segment,
+                                                                ([], []))
+        timesteps.append(timestep)
+        versions.append(version)
+        if version is not None:
+            self.segmentsByCell[version.cell].add(segment)
+        self.segmentsByTimestep[timestep].append(segment)
+
+    def versionAt(self, segment, timestep):
+        timesteps, versions = self.versionsBySegment.get(segment, ((), ()))
+        i = bisect.bisect_right(timesteps, timestep)
+        if i == 0:
+            return None
+        return versions[i - 1]
+
+    def discardBefore(self, timestep):
+        """
+        Discard the versions that aren't needed to reconstruct timestep or
+        later timesteps.
+        """
+        for t in xrange(self.firstTimestep, timestep + 1):
+            for segment in self.segmentsByTimestep.pop(t, ()):
+                self.discardSegmentBefore(segment, timestep)
+        self.firstTimestep = max(self.firstTimestep, timestep)
+
+    def discardSegmentBefore(self, segment, timestep):
+        if segment not in self.versionsBySegment:
+            return
+        timesteps, versions = self.versionsBySegment[segment]
+        i = bisect.bisect_right(timesteps, timestep) - 1
+        if i <= 0:
+            return
+
+        discarded = versions[:i]
+        del timesteps[:i]
+        del versions[:i]
+        if len(versions) == 1 and versions[0] is None:
+            del self.versionsBySegment[segment]
+
+        cells = set(version.cell for version in versions
+                    if version is not None)
+        for version in discarded:
+            if version is not None and version.cell not in cells:
+                self.segmentsByCell[version.cell].discard(segment)
+
+    def at(self, timestep):
+        """
+        Returns a HistoricalConnections of the connections at the end of
+        timestep. Raises SnapshotUnavailable if the timestep's versions have
+        been discarded.
+        """
+        if timestep < self.firstTimestep:
+            raise SnapshotUnavailable(timestep, 'evicted')
+        return HistoricalConnections(self, timestep)
+
+
+class HistoricalConnections(object):
+    """
+    A read-only view of a Connections as it was at the end of a timestep.
+
+    It supports the Connections methods that the segment extractors use, so
+    it can be passed to them in place of a Connections.
+    """
+    def __init__(self, versions, timestep):
+        self.versions = versions
+        self.timestep = timestep
+
+    def segmentsForCell(self, cell):
+        segments = []
+        for segment in self.versions.segmentsByCell.get(cell, ()):
+            version = self.versions.versionAt(segment, self.timestep)
+            if version is not None and version.cell == cell:
+                segments.append((version.ordinal, segment))
+        return [segment for _, segment in sorted(segments)]
+
+    def synapsesForSegment(self, segment):
+        version = self.versions.versionAt(segment, self.timestep)
+        return [SynapseData(presynapticCell, permanence)
+                for presynapticCell, permanence in zip(
+                        version.presynapticCells.astype(np.int64).tolist(),
+                        version.permanences.tolist())]
+
+    def dataForSynapse(self, synapse):
+        return synapse
+
+
+class SegmentChangeTracker(ConnectionsEventHandler):
+    """
+    Use a nupic.bindings Connections' events to track which segments were
+    created, destroyed or had their synapses changed.
+
+    Call start to subscribe to the events and close to unsubscribe.
+    """
+    def __init__(self, connections):
+        super(SegmentChangeTracker, self).__init__()
+        self.connections = connections
+        # The segments that changed since the last takeDirty.
+        self.dirty = set()
+
+    def start(self):
+        self.token = self.connections.subscribe(self.__disown__())
+
+    def close(self):
+        self.connections.unsubscribe(self.token)
+
+    def takeDirty(self):
+        dirty = self.dirty
+        self.dirty = set()
+        return dirty
+
+    def onCreateSegment(self, segment):
+        self.dirty.add(segment)
+
+    def onDestroySegment(self, segment):
+        self.dirty.add(segment)
+
+    def onCreateSynapse(self, synapse):
+        self.dirty.add(self.connections.dataForSynapse(synapse).segment)
+
+    def onDestroySynapse(self, synapse):
+        self.dirty.add(self.connections.dataForSynapse(synapse).segment)
+
+    def onUpdateSynapsePermanence(self, synapse, permanence):
+        self.dirty.add(self.connections.dataForSynapse(synapse).segment)
+
+
+class ConnectionsHistory(SegmentChangeTracker):
+    """
+    Record the history of a nupic.bindings Connections, copy-on-write.
+
+    The Connections' events say which segments change during a timestep. When
+    the timestep is committed, only those segments' synapses are copied. The
+    last keepSteps timesteps can be reconstructed with at, and older ones
+    raise SnapshotUnavailable. Call close to stop recording.
+    """
+    def __init__(self, connections, timestep, keepSteps=1):
+        super(ConnectionsHistory, self).__init__(connections)
+        self.keepSteps = keepSteps
+        self.versions = SegmentVersions(timestep)
+        # The existing segments, numbered in the order they were created.
+        self.ordinals = {}
+        self.nextOrdinal = 0
+
+        for cell in xrange(connections.numCells()):
+            for segment in connections.segmentsForCell(cell):
+                self.ordinals[segment] = self.nextOrdinal
+                self.nextOrdinal += 1
+                self.versions.record(timestep, segment,
+                                     self.readSegment(segment))
+
+        self.start()
+
+    def onCreateSegment(self, segment):
+        self.ordinals[segment] = self.nextOrdinal
+        self.nextOrdinal += 1
+        super(ConnectionsHistory, self).onCreateSegment(segment)
+
+    def onDestroySegment(self, segment):
+        del self.ordinals[segment]
+        super(ConnectionsHistory, self).onDestroySegment(segment)
+
+    def readSegment(self, segment):
+        synapses = [self.connections.dataForSynapse(synapse)
+                    for synapse in self.connections.synapsesForSegment(segment)]
+        return SegmentVersion(
+            self.connections.cellForSegment(segment),
+            self.ordinals[segment],
+            np.array([synapseData.presynapticCell for synapseData in synapses],
+                     dtype=np.uint32),
+            np.array([synapseData.permanence for synapseData in synapses],
+                     dtype=np.float32))
+
+    def commit(self, timestep):
+        """
+        Record the segments that changed during timestep.
+        """
+        for segment in self.takeDirty():
+            if segment in self.ordinals:
+                version = self.readSegment(segment)
+            else:
+                version = None
+            self.versions.record(timestep, segment, version)
+        self.versions.discardBefore(timestep - self.keepSteps)
+
+    @property
+    def firstTimestep(self):
+        return self.versions.firstTimestep
+
+    def at(self, timestep):
+        return self.versions.at(timestep)
@@ -1,4 +1,17 @@
 import collections
+import random
+import threading
+
+import numpy as np
+
+import marshalling as marshal
+from capture import CaptureWorker
+from lru import LRUCache
+from responses import ResponseCache, freeze
+from sdr import SDR, ColumnIndex
+from snapshots import SnapshotUnavailable, estimateSize, makeSnapshotStore
+from stats import (LAYER_STAT_INDEX, LayerStatsTable, computeLayerStats,
+                   downsample, getPredictedCells, getPredictedColumns)
 
 def expandSegmentSelector(segSelector, segsByCol, defaultCells):
     if isinstance(segSelector, collections.Mapping):
@@ -77,97 +90,411 @@ def parseSegmentSelector(segSelector):
 
     return columnGate
 
+def mergeOptions(options, overrides):
+    """Returns a copy of options, recursively updated with overrides."""
+    ret = dict(options)
+    for k, v in overrides.items():
+        if (isinstance(v, collections.Mapping) and
+            isinstance(ret.get(k), collections.Mapping)):
+            ret[k] = mergeOptions(ret[k], v)
+        else:
+            ret[k] = v
+    return ret
+
+# Each group of capture options and the segments it controls. Every group may
+# specify its own 'keep-steps', which is usually much shorter than the
+# journal's 'keep-steps' because segments are far bigger than bit states.
+SEGMENT_TIERS = (
+    ('ff-synapses', 'proximalSegments'),
+    ('distal-synapses', 'distalSegments'),
+    ('apical-synapses', 'apicalSegments'),
+)
+
+
+def extractBitStates(snapshot):
+    """
+    Select the parts of a snapshot that SanityModel.query's bitHistory
+    provides.
+    """
+    ret = {
+        'senses': {},
+        'layers': {},
+    }
+
+    for senseName, senseData in snapshot['senses'].items():
+        ret['senses'][senseName] = {
+            'activeBits': senseData['activeBits'],
+        }
+
+    for lyrId, layerData in snapshot['layers'].items():
+        ret['layers'][lyrId] = {
+            'activeCells': layerData['activeCells'],
+            'activeColumns': layerData['activeColumns'],
+        }
+
+        for k in ('predictedCells', 'predictedColumns',
+                  'predictiveCells', 'predictiveColumns'):
+            if k in layerData:
+                ret['layers'][lyrId][k] = layerData[k]
+
+    return ret
+
+
+def countBurstingColumns(bitStates, prevBitStates):
+    """
+    The number of active columns that weren't predicted, in the layer that
+    has the most of them.
+    """
+    ret = 0
+    for lyrId, layerData in bitStates['layers'].items():
+        prevLayerData = None
+        if prevBitStates is not None:
+            prevLayerData = prevBitStates['layers'].get(lyrId)
+        predictedColumns = getPredictedColumns(layerData, prevLayerData)
+        ret = max(ret, len(layerData['activeColumns'] - predictedColumns))
+    return ret
+
+
+def addPriorPredictions(modelData, prevBitStates):
+    """
+    Give each layer of a timestep the bits that were predicted for it, if the
+    model only says what it predicts for the next timestep. They're copied
+    from the previous timestep's bit states, so they're right even when the
+    previous snapshot isn't the previous timestep.
+    """
+    if prevBitStates is None:
+        return
+
+    for lyrId, layerData in modelData['layers'].items():
+        prevLayerData = prevBitStates['layers'].get(lyrId)
+        if prevLayerData is None:
+            continue
+        for suffix in ('Cells', 'Columns'):
+            if ('predicted' + suffix not in layerData and
+                'predictive' + suffix in prevLayerData):
+                layerData['predicted' + suffix] = (
+                    prevLayerData['predictive' + suffix])
+
+
+def putBits(ret, fetch, bits, cachedOnscreenBits):
+    """
+    Add bits to a response.
+
+    cachedOnscreenBits is the argument after the fetches in get-layer-bits
+    and get-sense-bits. It's either None or a dict that maps a fetch, like
+    'active-columns', to the bits that the client has onscreen for it. Older
+    clients send other values, which are ignored.
+
+    If the client says which bits it has onscreen for this fetch, and the
+    difference is smaller than the bits, the response gets the difference
+    under the key fetch + '-diff', as {'added': SDR, 'removed': SDR}.
+    Otherwise it gets the bits under the key fetch, as usual.
+    """
+    onscreen = None
+    if isinstance(cachedOnscreenBits, collections.Mapping):
+        onscreen = cachedOnscreenBits.get(fetch)
+
+    if onscreen is not None:
+        # Don't size it, in case the client has bits that are out of range.
+        onscreen = SDR(onscreen)
+        added = bits - onscreen
+        removed = onscreen - bits
+        if len(added) + len(removed) < len(bits):
+            ret[fetch + '-diff'] = {
+                'added': added,
+                'removed': removed,
+            }
+            return
+
+    ret[fetch] = bits
+
+
+def bitHistoryFrom(prevBitStates):
+    if prevBitStates is not None:
+        yield prevBitStates
+
+
+# Requests that are answered from a single snapshot, given as the first
+# argument. Their responses are cached.
+CACHED_COMMANDS = frozenset([
+    'get-layer-bits',
+    'get-sense-bits',
+    'get-column-cells',
+    'get-columns-cells',
+    'get-layer-stats',
+    'get-apical-segments',
+    'get-distal-segments',
+    'get-proximal-segments',
+    'get-apical-synapses',
+    'get-distal-synapses',
+    'get-proximal-synapses',
+])
+
+
+# Cached requests whose responses can be sent as diffs against the bits that
+# the client has onscreen.
+BITS_COMMANDS = frozenset([
+    'get-layer-bits',
+    'get-sense-bits',
+])
+
+
+# Requests whose arguments don't end with a response channel, because
+# there's no response.
+NO_RESPONSE_COMMANDS = frozenset([
+    'connect',
+    'ping',
+    'subscribe',
+    'set-capture-options',
+    'set-region-of-interest',
+    'seek',
+])
+
+
+class ResponseCollector(object):
+    """
+    A channel that keeps the response to one request of a batch.
+    """
+    def __init__(self):
+        self.response = None
+
+    def put(self, v):
+        self.response = v
+
+
 class Journal(object):
     def __init__(self, sanityModel, captureOptions=None):
-        self.journal = []
-        self.subscribers = []
-        self.nextSnapshotId = 0
-
-        if captureOptions is not None:
-            self.captureOptions = captureOptions
-        else:
+        if captureOptions is None:
             # The captureOptions and networkShape are shared with the client.
             # Use hyphenated keys for these public formats.
-            self.captureOptions = {
+            captureOptions = {
                 'keep-steps': 50,
+                # Optional memory budget. When set, the oldest snapshots are
+                # also evicted whenever the journal's estimated size exceeds
+                # this many bytes.
+                'keep-bytes': None,
+                # Memory budget for cached responses. None disables the cache.
+                'response-cache-bytes': 16 * 1024 * 1024,
+                # How snapshots are stored. See makeSnapshotStore. This is
+                # only read when the journal is created.
+                'storage': {
+                    'mode': 'memory',
+                },
+                # Whether to build snapshots on a background thread so that
+                # the model doesn't wait for them. The model's thread still
+                # copies the captured synapses, as LazySegments. Classifying
+                # and summarizing them happens on the background thread.
+                # See CaptureWorker.
+                'background': {
+                    'enabled?': False,
+                    'queue-size': 16,
+                    # 'block', 'drop' or 'decimate'
+                    'when-full': 'block',
+                },
+                # Each type of synapse can be captured on a sample of the
+                # timesteps. If any of 'every-n-steps', 'sample-fraction' and
+                # 'min-bursting-columns' are set, or a predicate is set with
+                # setCapturePredicate, synapses are captured on the timesteps
+                # that match at least one of them.
                 'ff-synapses': {
                     'capture?': False,
                     'only-active?': True,
                     'only-connected?': True,
+                    'every-n-steps': None,
+                    'sample-fraction': None,
+                    'min-bursting-columns': None,
                 },
                 'distal-synapses': {
                     'capture?': False,
                     'only-active?': True,
                     'only-connected?': True,
                     'only-noteworthy-columns?': True,
+                    # Capture a compact copy of the synapses, and only
+                    # summarize the segments that are requested. See
+                    # LazySegments.
+                    'lazy?': False,
+                    # Show the synapses as they were at the beginning of the
+                    # timestep, when the model computed which segments were
+                    # active, rather than after learning. Segments grown
+                    # during the timestep aren't shown. Only models built on
+                    # nupic.bindings Connections support this.
+                    'before-learning?': False,
+                    # Only summarize the segments that changed since the
+                    # previous capture. See IncrementalSegments.
+                    'incremental?': False,
+                    'every-n-steps': None,
+                    'sample-fraction': None,
+                    'min-bursting-columns': None,
                 },
                 'apical-synapses': {
                     'capture?': False,
                     'only-active?': True,
                     'only-connected?': True,
                     'only-noteworthy-columns?': True,
+                    # Capture a compact copy of the synapses, and only
+                    # summarize the segments that are requested. See
+                    # LazySegments.
+                    'lazy?': False,
+                    # Show the synapses as they were at the beginning of the
+                    # timestep, when the model computed which segments were
+                    # active, rather than after learning. Segments grown
+                    # during the timestep aren't shown. Only models built on
+                    # nupic.bindings Connections support this.
+                    'before-learning?': False,
+                    # Only summarize the segments that changed since the
+                    # previous capture. See IncrementalSegments.
+                    'incremental?': False,
+                    'every-n-steps': None,
+                    'sample-fraction': None,
+                    'min-bursting-columns': None,
                 },
             }
 
-        networkLayout = sanityModel.query(self.getBitHistory, getNetworkLayout=True)
-        self.networkShape = {
+        networkLayout = sanityModel.query(bitHistoryFrom(None),
+                                          getNetworkLayout=True)
+        networkShape = {
             'senses': {},
             'layers': {},
         }
         for senseId, sense in networkLayout['senses'].items():
-            self.networkShape['senses'][senseId] = {
+            networkShape['senses'][senseId] = {
                 'ordinal': sense['ordinal'],
                 'dimensions': sense['dimensions'],
             }
 
         for lyrId, layerData in networkLayout['layers'].items():
-            self.networkShape['layers'][lyrId] = {
+            networkShape['layers'][lyrId] = {
                 'ordinal': layerData['ordinal'],
                 'cells-per-column': layerData['cellsPerColumn'],
                 'dimensions': layerData['dimensions'],
             }
 
+        self.initState(captureOptions, networkShape,
+                       makeSnapshotStore(captureOptions))
+
+        self.saveHeader()
+        self.recordConnectionsHistories(sanityModel)
         self.append(sanityModel)
-        sanityModel.addEventListener('didStep', lambda: self.append(sanityModel))
+        sanityModel.addEventListener('didStep',
+                                     lambda: self.onModelStepped(sanityModel))
 
     # Act like a channel.
     def put(self, v):
         self.handleMessage(v)
 
+    def initState(self, captureOptions, networkShape, snapshots):
+        """
+        Set up a journal of snapshots, which is a SnapshotRingBuffer. Every
+        kind of journal calls this from its constructor.
+        """
+        self.subscribers = []
+        self.captureOptions = captureOptions
+        self.networkShape = networkShape
+        self.journal = snapshots
+
+        # Held while the journal is modified or read. Background captures are
+        # stored on another thread.
+        self.lock = threading.RLock()
+        self.worker = None
+        # The newest bit states, for querying the next timestep.
+        self.prevBitStates = None
+        self.capturePredicates = {}
+        # The columns the client is looking at, by layer. When a layer has a
+        # region of interest, segments are only captured for its columns.
+        self.regionsOfInterest = {}
+
+        # For each segment type, the first snapshot that hasn't been compacted.
+        self.compactedUntil = dict((segmentsKey, 0)
+                                   for _, segmentsKey in SEGMENT_TIERS)
+
+        self.initDerivedState()
+
+    def initDerivedState(self):
+        """
+        Create the state that's derived from the snapshots to answer requests
+        quickly.
+        """
+        self.layerStats = LayerStatsTable(self.networkShape['layers'].keys())
+        # ColumnIndexes of recently requested snapshots, built on demand.
+        self.columnIndexes = LRUCache(64)
+
+        cacheBytes = self.captureOptions.get('response-cache-bytes',
+                                             16 * 1024 * 1024)
+        if cacheBytes is not None:
+            self.responseCache = ResponseCache(cacheBytes)
+        else:
+            self.responseCache = None
+
+    def saveHeader(self):
+        self.journal.saveHeader({
+            'network-shape': self.networkShape,
+            'capture-options': self.captureOptions,
+        })
+
     def getBitHistory(self):
         # Don't store this return value for too long.
         # It's invalid after self.journal is modified.
-        for entry in reversed(self.journal):
-            ret = {
-                'senses': {},
-                'layers': {},
-            }
-
-            for senseName, senseData in entry['senses'].items():
-                ret['senses'][senseName] = {
-                    'activeBits': senseData['activeBits'],
-                }
-
-            for lyrId, layerData in entry['layers'].items():
-                ret['layers'][lyrId] = {
-                    'activeCells': layerData['activeCells'],
-                    'activeColumns': layerData['activeColumns'],
-                }
-
-                for k in ('predictedCells', 'predictedColumns',
-                          'predictiveCells', 'predictiveColumns'):
-                    if k in layerData:
-                        ret['layers'][lyrId][k] = layerData[k]
+        for entry in self.journal.reversedSnapshots():
+            yield extractBitStates(entry)
+
+    def setCapturePredicate(self, optionsKey, predicate):
+        """
+        Capture a type of synapses on the timesteps where predicate returns
+        True, e.g. journal.setCapturePredicate('distal-synapses', fn).
+
+        The predicate is called with the timestep and its bit states, in the
+        format returned by SanityModel.query. Pass None to remove it.
+        """
+        assert optionsKey in dict(SEGMENT_TIERS)
+        if predicate is None:
+            self.capturePredicates.pop(optionsKey, None)
+        else:
+            self.capturePredicates[optionsKey] = predicate
+
+    def selectSynapseCapture(self, timestep, getBitStates, prevBitStates):
+        """
+        Choose which types of synapses to capture on this timestep, according
+        to each type's sampling options. Returns a list of option keys.
+
+        getBitStates returns the timestep's bit states. It's only called if
+        'min-bursting-columns' or a predicate needs them.
+        """
+        ret = []
+        for optionsKey, _ in SEGMENT_TIERS:
+            options = self.captureOptions[optionsKey]
+            if not options['capture?']:
+                continue
+
+            everyN = options.get('every-n-steps')
+            fraction = options.get('sample-fraction')
+            minBursting = options.get('min-bursting-columns')
+            predicate = self.capturePredicates.get(optionsKey)
+
+            if (everyN is None and fraction is None and minBursting is None
+                and predicate is None):
+                ret.append(optionsKey)
+            elif everyN is not None and timestep % everyN == 0:
+                ret.append(optionsKey)
+            elif fraction is not None and random.random() < fraction:
+                ret.append(optionsKey)
+            elif (minBursting is not None and
+                  countBurstingColumns(getBitStates(),
+                                       prevBitStates) >= minBursting):
+                ret.append(optionsKey)
+            elif predicate is not None and predicate(timestep, getBitStates()):
+                ret.append(optionsKey)
 
-            yield ret
+        return ret
 
-    def append(self, sanityModel):
-        queryArgs = {
-            'bitHistory': self.getBitHistory(),
-            'getBitStates': True,
-        }
+    def getSegmentQueryArgs(self, captured, lazy=False):
+        """
+        Returns the query arguments for capturing these types of synapses.
+        With lazy, the distal and apical segments are always captured as
+        LazySegments.
+        """
+        queryArgs = {}
 
-        if self.captureOptions['ff-synapses']['capture?']:
+        if 'ff-synapses' in captured:
             onlyActive = self.captureOptions['ff-synapses']['only-active?']
             onlyConnected = self.captureOptions['ff-synapses']['only-connected?']
             queryArgs.update({
@@ -175,56 +502,381 @@ class Journal(object):
                 'proximalSegmentsQuery': {
                     'onlyActiveSynapses': onlyActive,
                     'onlyConnectedSynapses': onlyConnected,
+                    'regionsOfInterest': dict(self.regionsOfInterest),
                 },
             })
 
-        if self.captureOptions['distal-synapses']['capture?']:
+        if 'distal-synapses' in captured:
             onlyActive = self.captureOptions['distal-synapses']['only-active?']
             onlyConnected = self.captureOptions['distal-synapses']['only-connected?']
             onlyNoteworthy = self.captureOptions['distal-synapses']['only-noteworthy-columns?']
+            distalLazy = (lazy or
+                          self.captureOptions['distal-synapses'].get('lazy?',
+                                                                     False))
+            beforeLearning = self.captureOptions['distal-synapses'].get(
+                'before-learning?', False)
+            incremental = self.captureOptions['distal-synapses'].get(
+                'incremental?', False)
             queryArgs.update({
                 'getDistalSegments': True,
                 'distalSegmentsQuery': {
                     'onlyActiveSynapses': onlyActive,
                     'onlyConnectedSynapses': onlyConnected,
                     'onlyNoteworthyColumns': onlyNoteworthy,
+                    'regionsOfInterest': dict(self.regionsOfInterest),
+                    'lazy': distalLazy,
+                    'beforeLearning': beforeLearning,
+                    'incremental': incremental,
                 },
             })
 
-        if self.captureOptions['apical-synapses']['capture?']:
+        if 'apical-synapses' in captured:
             onlyActive = self.captureOptions['apical-synapses']['only-active?']
             onlyConnected = self.captureOptions['apical-synapses']['only-connected?']
             onlyNoteworthy = self.captureOptions['apical-synapses']['only-noteworthy-columns?']
+            apicalLazy = (lazy or
+                          self.captureOptions['apical-synapses'].get('lazy?',
+                                                                     False))
+            beforeLearning = self.captureOptions['apical-synapses'].get(
+                'before-learning?', False)
+            incremental = self.captureOptions['apical-synapses'].get(
+                'incremental?', False)
             queryArgs.update({
                 'getApicalSegments': True,
                 'apicalSegmentsQuery': {
                     'onlyActiveSynapses': onlyActive,
                     'onlyConnectedSynapses': onlyConnected,
                     'onlyNoteworthyColumns': onlyNoteworthy,
+                    'regionsOfInterest': dict(self.regionsOfInterest),
+                    'lazy': apicalLazy,
+                    'beforeLearning': beforeLearning,
+                    'incremental': incremental,
                 },
             })
 
-        modelData = sanityModel.query(**queryArgs)
-
-        self.journal.append(modelData)
-
-        # TODO: only keep nKeepSteps models
-
-        snapshotId = self.nextSnapshotId
-        self.nextSnapshotId += 1
+        return queryArgs
 
-        step = {
-            'snapshot-id': snapshotId,
+    def getStep(self, sanityModel, captured):
+        return {
             'timestep': sanityModel.timestep,
-            'display-value': sanityModel.getInputDisplayText()
+            'display-value': sanityModel.getInputDisplayText(),
+            # Which types of synapses this snapshot has.
+            'captured-synapses': captured,
         }
 
+    def recordConnectionsHistories(self, sanityModel):
+        """
+        Have the model record the history of the synapses that are captured
+        'before-learning?'.
+        """
+        segmentsKeys = []
+        for optionsKey, segmentsKey in SEGMENT_TIERS:
+            options = self.captureOptions[optionsKey]
+            if options['capture?'] and options.get('before-learning?', False):
+                segmentsKeys.append(segmentsKey)
+        sanityModel.recordConnectionsHistories(segmentsKeys)
+
+    def onModelStepped(self, sanityModel):
+        self.recordConnectionsHistories(sanityModel)
+
+        background = self.captureOptions.get('background') or {}
+        if not background.get('enabled?', False):
+            if self.worker is not None:
+                # Keep the snapshots in order.
+                self.worker.join()
+            self.append(sanityModel)
+        else:
+            self.appendInBackground(sanityModel,
+                                    background.get('queue-size', 16),
+                                    background.get('when-full', 'block'))
+
+    def queryTimestep(self, sanityModel, getBitHistory, prevBitStates,
+                      lazy=False):
+        """
+        Query the model for the timestep's bit states and for the synapses
+        that selectSynapseCapture chooses. Returns the query's result and the
+        chosen option keys.
+
+        The model is usually queried once. It's only queried for its bit
+        states first when they're needed to choose the synapses.
+        """
+        bitStates = []
+        def getBitStates():
+            if not bitStates:
+                bitStates.append(sanityModel.query(getBitHistory(),
+                                                   getBitStates=True))
+            return bitStates[0]
+
+        captured = self.selectSynapseCapture(sanityModel.timestep,
+                                             getBitStates, prevBitStates)
+        if captured:
+            modelData = sanityModel.query(
+                getBitHistory(), getBitStates=True,
+                **self.getSegmentQueryArgs(captured, lazy))
+        else:
+            modelData = getBitStates()
+        return modelData, captured
+
+    def append(self, sanityModel):
+        with self.lock:
+            prevBitStates = self.prevBitStates
+            modelData, captured = self.queryTimestep(sanityModel,
+                                                     self.getBitHistory,
+                                                     prevBitStates)
+            self.prevBitStates = extractBitStates(modelData)
+            self.store(modelData, self.getStep(sanityModel, captured),
+                       prevBitStates)
+
+    def appendInBackground(self, sanityModel, queueSize, whenFull):
+        """
+        Capture the timestep on the model's thread as cheaply as possible, and
+        let the CaptureWorker build and store the snapshot.
+
+        The bit states are always queried, because they're needed for the
+        next timestep even if this one isn't captured. When synapses are
+        captured, they're queried at the same time, as LazySegments, which
+        only copy the selected columns' synapses. Classifying the synapses,
+        building the segment summaries, storing the snapshot and answering
+        requests about it happen elsewhere.
+        """
+        if self.worker is None:
+            self.worker = CaptureWorker(self.processCapture, queueSize,
+                                        whenFull)
+        else:
+            self.worker.configure(queueSize, whenFull)
+
+        prevBitStates = self.prevBitStates
+        if not self.worker.shouldCapture():
+            modelData = sanityModel.query(bitHistoryFrom(prevBitStates),
+                                          getBitStates=True)
+            self.prevBitStates = extractBitStates(modelData)
+            return
+
+        modelData, captured = self.queryTimestep(
+            sanityModel, lambda: bitHistoryFrom(prevBitStates), prevBitStates,
+            lazy=True)
+        self.prevBitStates = extractBitStates(modelData)
+
+        # Some timesteps may not be captured, so the worker can't find the
+        # previous timestep's bit states in the journal.
+        self.worker.submit((modelData, self.getStep(sanityModel, captured),
+                            prevBitStates))
+
+    def processCapture(self, capture):
+        modelData, step, prevBitStates = capture
+        self.store(modelData, step, prevBitStates)
+
+    def store(self, modelData, step, prevBitStates):
+        """
+        Append a timestep's snapshot. prevBitStates are the previous
+        timestep's bit states, whether or not it has a snapshot.
+        """
+        with self.lock:
+            snapshotId = self.journal.nextSnapshotId
+            addPriorPredictions(modelData, prevBitStates)
+            self.layerStats.set(snapshotId, computeLayerStats(modelData, None))
+
+            step['snapshot-id'] = snapshotId
+            # Keep the step with the snapshot so that a recorded journal can
+            # be replayed.
+            modelData['step'] = step
+
+            self.journal.append(modelData)
+            self.compact()
+            self.enforceMemoryBudget()
+            self.discardStaleResponses()
+            self.notify(step)
+
+    def notify(self, step):
         for subscriber in self.subscribers:
             subscriber.put(step)
 
+    def compact(self):
+        """
+        Strip segments from snapshots that have aged past their retention tier,
+        keeping the cheap bit states.
+
+        This runs after every append, so each pass usually only compacts a
+        single snapshot per segment type.
+        """
+        for optionsKey, segmentsKey in SEGMENT_TIERS:
+            keepSteps = self.captureOptions[optionsKey].get('keep-steps')
+            if keepSteps is None:
+                continue
+
+            start = max(self.compactedUntil[segmentsKey],
+                        self.journal.firstSnapshotId)
+            stop = self.journal.nextSnapshotId - keepSteps
+            for snapshotId in xrange(start, stop):
+                self.journal.stripSegments(snapshotId, segmentsKey)
+                if self.responseCache is not None:
+                    self.responseCache.invalidate(snapshotId)
+
+            self.compactedUntil[segmentsKey] = max(
+                self.compactedUntil[segmentsKey], stop)
+
+    def getSegments(self, snapshotId, lyrId, segmentsKey):
+        modelData = self.journal[snapshotId]
+        optionsKey = dict((s, o) for o, s in SEGMENT_TIERS)[segmentsKey]
+        if optionsKey not in modelData['step']['captured-synapses']:
+            raise SnapshotUnavailable(snapshotId, 'not-captured')
+        layerData = modelData['layers'][lyrId]
+        compacted = (snapshotId < self.compactedUntil[segmentsKey] and
+                     not self.journal.keepsStrippedSegments(snapshotId))
+        if compacted or not self.journal.hasSegments(snapshotId):
+            raise SnapshotUnavailable(snapshotId, 'compacted')
+        return layerData, layerData.get(segmentsKey, {})
+
+    def getLayerStats(self, snapshotId, lyrId):
+        """
+        Returns the layer's LAYER_STATS values for a snapshot. They're
+        normally computed when the snapshot is appended.
+        """
+        if snapshotId not in self.layerStats:
+            self.layerStats.set(snapshotId,
+                                computeLayerStats(
+                                    self.journal[snapshotId],
+                                    self.getPreviousTimestep(snapshotId)))
+        return self.layerStats.get(snapshotId, lyrId)
+
+    def getPreviousTimestep(self, snapshotId):
+        """
+        Returns the snapshot of the timestep before a snapshot's timestep, or
+        None if it isn't in the journal.
+
+        Snapshots normally have their predicted bits. See
+        addPriorPredictions. This is for snapshots that don't.
+        """
+        if snapshotId - 1 not in self.journal:
+            return None
+        prevModelData = self.journal[snapshotId - 1]
+        if (prevModelData['step']['timestep'] !=
+            self.journal[snapshotId]['step']['timestep'] - 1):
+            return None
+        return prevModelData
+
+    def getLayerStatsRange(self, start, stop, lyrId):
+        for snapshotId in xrange(start, stop):
+            if snapshotId not in self.layerStats:
+                self.getLayerStats(snapshotId, lyrId)
+        return self.layerStats.getRange(start, stop, lyrId)
+
+    def getColumnIndexes(self, snapshotId, lyrId):
+        """
+        Returns ColumnIndexes of a snapshot's active and predicted cells.
+        """
+        self.journal.checkAvailable(snapshotId)
+        key = (snapshotId, lyrId)
+        indexes = self.columnIndexes.get(key)
+        if indexes is None:
+            layerData = self.journal[snapshotId]['layers'][lyrId]
+            prevLayerData = None
+            if 'predictedCells' not in layerData:
+                prevModelData = self.getPreviousTimestep(snapshotId)
+                if prevModelData is not None:
+                    prevLayerData = prevModelData['layers'][lyrId]
+
+            layerTemplate = self.networkShape['layers'][lyrId]
+            cellsPerColumn = layerTemplate['cells-per-column']
+            nColumns = int(np.prod(layerTemplate['dimensions']))
+            indexes = {
+                'active-cells': ColumnIndex(layerData['activeCells'],
+                                            cellsPerColumn, nColumns),
+                'prior-predicted-cells': ColumnIndex(
+                    getPredictedCells(layerData, prevLayerData),
+                    cellsPerColumn, nColumns),
+            }
+            self.columnIndexes.put(key, indexes)
+
+        return indexes
+
+    def getColumnCells(self, snapshotId, lyrId, col, fetches):
+        indexes = self.getColumnIndexes(snapshotId, lyrId)
+        ret = {}
+        for fetch in ('active-cells', 'prior-predicted-cells'):
+            if fetch in fetches:
+                ret[fetch] = indexes[fetch].cellsInColumn(col)
+        return ret
+
+    def enforceMemoryBudget(self):
+        keepBytes = self.captureOptions.get('keep-bytes')
+        if keepBytes is not None:
+            # Always keep the newest snapshot.
+            while self.journal.totalBytes > keepBytes and len(self.journal) > 1:
+                self.journal.evictOldest()
+
+    def discardStaleResponses(self):
+        """
+        Discard cached responses about snapshots that have been evicted.
+        Snapshots that are still readable, like a disk journal's cold
+        snapshots, keep their responses.
+        """
+        if self.responseCache is not None:
+            self.responseCache.invalidateMissing(self.journal)
+
+    def handleCachedCommand(self, command, args):
+        """
+        Answer a request from the response cache, if possible.
+
+        Responses are keyed on the command, the snapshot and the query. The
+        bits commands' cachedOnscreenBits isn't part of the key. Their full
+        response is cached, and any diff against the client's onscreen bits
+        is made from it per request.
+        """
+        responseChannelMarshal = args[-1]
+        query = list(args[:-1])
+        cachedOnscreenBits = None
+        if command in BITS_COMMANDS:
+            snapshotId, sourceId, fetches, cachedOnscreenBits = query
+            if not isinstance(cachedOnscreenBits, collections.Mapping):
+                # There's nothing to diff against. See putBits.
+                cachedOnscreenBits = None
+            query = [snapshotId, sourceId, frozenset(fetches), None]
+        key = (command,) + freeze(query)
+
+        entry = self.responseCache.get(key)
+        if entry is None:
+            collector = ResponseCollector()
+            self.handleCommand(command,
+                               query + [marshal.channel(collector)])
+            response = collector.response
+            nBytes = estimateSize(response)
+            if command in BITS_COMMANDS:
+                # Keep the bits too, to diff against the onscreen bits.
+                entry = (marshal.preEncoded(response), response)
+                nBytes *= 2
+            else:
+                entry = (marshal.preEncoded(response), None)
+            self.responseCache.put(key, query[0], entry, nBytes)
+
+        encoded, bitsResponse = entry
+        if cachedOnscreenBits is None:
+            responseChannelMarshal.ch.put(encoded)
+        else:
+            ret = {}
+            for fetch, bits in bitsResponse.items():
+                putBits(ret, fetch, bits, cachedOnscreenBits)
+            responseChannelMarshal.ch.put(ret)
+
     def handleMessage(self, msg):
         command = msg[0]
         args = msg[1:]
+        try:
+            with self.lock:
+                if (command in CACHED_COMMANDS and
+                    self.responseCache is not None):
+                    self.handleCachedCommand(command, args)
+                else:
+                    self.handleCommand(command, args)
+        except SnapshotUnavailable as e:
+            # Every snapshot request ends with a response channel.
+            responseChannelMarshal = args[-1]
+            responseChannelMarshal.ch.put({
+                'unavailable': e.reason,
+                'snapshot-id': e.snapshotId,
+            })
+
+    def handleCommand(self, command, args):
         if command == 'connect':
             pass
         elif command == 'ping':
@@ -241,11 +893,26 @@ class Journal(object):
             responseChannelMarshal, = args
             responseChannelMarshal.ch.put(self.captureOptions)
 
+        elif command == 'get-memory-usage':
+            responseChannelMarshal, = args
+            snapshotIds = xrange(self.journal.firstSnapshotId,
+                                 self.journal.nextSnapshotId)
+            responseChannelMarshal.ch.put({
+                'total-bytes': self.journal.totalBytes,
+                'keep-bytes': self.captureOptions.get('keep-bytes'),
+                'first-snapshot-id': self.journal.firstSnapshotId,
+                'snapshot-bytes': [self.journal.getSize(snapshotId)
+                                   for snapshotId in snapshotIds],
+                'layer-stats-bytes': self.layerStats.nbytes,
+                'response-cache': (self.responseCache.getStats()
+                                   if self.responseCache is not None
+                                   else None),
+            })
+
         elif command == 'get-apical-segments':
             snapshotId, lyrId, segSelector, responseChannelMarshal = args
-            modelData = self.journal[snapshotId]
-            layerData = modelData['layers'][lyrId]
-            segsByCol = layerData.get('apicalSegments', {})
+            layerData, segsByCol = self.getSegments(snapshotId, lyrId,
+                                                    'apicalSegments')
 
             layerTemplate = self.networkShape['layers'][lyrId]
             defaultCells = range(layerTemplate['cells-per-column'])
@@ -271,9 +938,8 @@ class Journal(object):
 
         elif command == 'get-distal-segments':
             snapshotId, lyrId, segSelector, responseChannelMarshal = args
-            modelData = self.journal[snapshotId]
-            layerData = modelData['layers'][lyrId]
-            segsByCol = layerData.get('distalSegments', {})
+            layerData, segsByCol = self.getSegments(snapshotId, lyrId,
+                                                    'distalSegments')
 
             layerTemplate = self.networkShape['layers'][lyrId]
             defaultCells = range(layerTemplate['cells-per-column'])
@@ -299,9 +965,8 @@ class Journal(object):
 
         elif command == 'get-proximal-segments':
             snapshotId, lyrId, segSelector, responseChannelMarshal = args
-            modelData = self.journal[snapshotId]
-            layerData = modelData['layers'][lyrId]
-            segsByCol = layerData.get('proximalSegments', {})
+            layerData, segsByCol = self.getSegments(snapshotId, lyrId,
+                                                    'proximalSegments')
 
             defaultCells = [-1]
             selectedIndices = expandSegmentSelector(segSelector, segsByCol, [-1])
@@ -320,39 +985,52 @@ class Journal(object):
         elif command == 'get-layer-stats':
             snapshotId, lyrId, fetches, responseChannelMarshal = args
 
-            modelData = self.journal[snapshotId]
-            layerData = modelData['layers'][lyrId]
-            if 'predictedColumns' in layerData:
-                predictedColumns = set(layerData['predictedColumns'])
-            elif snapshotId > 0:
-                prevModelData = self.journal[snapshotId - 1]
-                prevLayerData = prevModelData['layers'][lyrId]
-                predictedColumns = prevLayerData['predictiveColumns']
-            else:
-                predictedColumns = set()
-
-            modelData = self.journal[snapshotId]
-            layerData = modelData['layers'][lyrId]
-            activeColumns = layerData['activeColumns']
-
+            stats = self.getLayerStats(snapshotId, lyrId)
             ret = {}
+            for fetch in fetches:
+                if fetch in LAYER_STAT_INDEX:
+                    ret[fetch] = int(stats[LAYER_STAT_INDEX[fetch]])
 
-            if 'n-unpredicted-active-columns' in fetches:
-                ret['n-unpredicted-active-columns'] = len(activeColumns - predictedColumns)
+            responseChannelMarshal.ch.put(ret)
 
-            if 'n-predicted-inactive-columns' in fetches:
-                ret['n-predicted-inactive-columns'] = len(predictedColumns - activeColumns)
+        elif command == 'get-layer-stats-range':
+            # Fetch stats for snapshots start through stop - 1 in one message.
+            # If maxPoints is given, consecutive snapshots are grouped into at
+            # most that many buckets, and each bucket's min, max and mean are
+            # returned.
+            (start, stop, lyrId, fetches, maxPoints,
+             responseChannelMarshal) = args
+
+            if maxPoints is not None and maxPoints < 1:
+                responseChannelMarshal.ch.put({
+                    'error': "max-points must be at least 1, not %s" % (
+                        maxPoints,),
+                })
+                return
+
+            start = max(start, 0)
+            stop = min(stop, self.journal.nextSnapshotId)
+            stats = self.getLayerStatsRange(start, stop, lyrId)
+            starts, mins, maxes, means = downsample(stats, maxPoints)
 
-            if 'n-predicted-active-columns' in fetches:
-                ret['n-predicted-active-columns'] = len(activeColumns & predictedColumns)
+            ret = {
+                'snapshot-ids': (starts + start).tolist(),
+            }
+            for fetch in fetches:
+                if fetch in LAYER_STAT_INDEX:
+                    i = LAYER_STAT_INDEX[fetch]
+                    ret[fetch] = {
+                        'min': mins[:, i].astype(np.int64).tolist(),
+                        'max': maxes[:, i].astype(np.int64).tolist(),
+                        'mean': means[:, i].tolist(),
+                    }
 
             responseChannelMarshal.ch.put(ret)
 
         elif command == 'get-apical-synapses':
             snapshotId, lyrId, segSelector, synStates, responseChannelMarshal = args
-            modelData = self.journal[snapshotId]
-            layerData = modelData['layers'][lyrId]
-            segsByCol = layerData.get('apicalSegments', {})
+            layerData, segsByCol = self.getSegments(snapshotId, lyrId,
+                                                    'apicalSegments')
 
             layerTemplate = self.networkShape['layers'][lyrId]
             defaultCells = range(layerTemplate['cells-per-column'])
@@ -363,9 +1041,8 @@ class Journal(object):
 
         elif command == 'get-distal-synapses':
             snapshotId, lyrId, segSelector, synStates, responseChannelMarshal = args
-            modelData = self.journal[snapshotId]
-            layerData = modelData['layers'][lyrId]
-            segsByCol = layerData.get('distalSegments', {})
+            layerData, segsByCol = self.getSegments(snapshotId, lyrId,
+                                                    'distalSegments')
 
             layerTemplate = self.networkShape['layers'][lyrId]
             defaultCells = range(layerTemplate['cells-per-column'])
@@ -376,9 +1053,8 @@ class Journal(object):
 
         elif command == 'get-proximal-synapses':
             snapshotId, lyrId, segSelector, synStates, responseChannelMarshal = args
-            modelData = self.journal[snapshotId]
-            layerData = modelData['layers'][lyrId]
-            segsByCol = layerData.get('proximalSegments', {})
+            layerData, segsByCol = self.getSegments(snapshotId, lyrId,
+                                                    'proximalSegments')
 
             defaultCells = [-1]
             selectedIndices = expandSegmentSelector(segSelector, segsByCol, defaultCells)
@@ -389,55 +1065,42 @@ class Journal(object):
 
         elif command == 'get-column-cells':
             snapshotId, lyrId, col, fetches, responseChannelMarshal = args
-            modelData = self.journal[snapshotId]
-            layerData = modelData['layers'][lyrId]
-            layerTemplate = self.networkShape['layers'][lyrId]
-            cellsPerColumn = layerTemplate['cells-per-column']
-            firstCellInCol = col * cellsPerColumn
-            activeCellsInCol = set(cellId - firstCellInCol
-                                   for cellId in layerData['activeCells']
-                                   if (cellId >= firstCellInCol and
-                                       cellId < firstCellInCol + cellsPerColumn))
-            predictedCellsInCol = []
-
-            if 'predictedCells' in layerData:
-                predictedCells = set(layerData['predictedCells'])
-            elif snapshotId > 0:
-                prevModelData = self.journal[snapshotId - 1]
-                prevLayerData = prevModelData['layers'][lyrId]
-                predictedCells = prevLayerData['predictiveCells']
-            else:
-                predictedCells = set()
+            responseChannelMarshal.ch.put(
+                self.getColumnCells(snapshotId, lyrId, col, fetches))
 
-            predictedCellsInCol = set(cellId - firstCellInCol
-                                      for cellId in predictedCells
-                                      if (cellId >= firstCellInCol and
-                                          cellId < firstCellInCol + cellsPerColumn))
+        elif command == 'get-columns-cells':
+            # Like get-column-cells, for many columns. The response is keyed
+            # by column.
+            snapshotId, lyrId, cols, fetches, responseChannelMarshal = args
             ret = {}
-
-            if 'active-cells' in fetches:
-                ret['active-cells'] = activeCellsInCol
-
-            if 'prior-predicted-cells' in fetches:
-                ret['prior-predicted-cells'] = predictedCellsInCol
+            for col in cols:
+                ret[col] = self.getColumnCells(snapshotId, lyrId, col, fetches)
 
             responseChannelMarshal.ch.put(ret)
 
         elif command == 'get-layer-bits':
+            # cachedOnscreenBits optionally maps each fetch to the bits that
+            # the client already has onscreen. Fetches that it covers may be
+            # answered with a '<fetch>-diff'. See putBits.
             snapshotId, lyrId, fetches, cachedOnscreenBits, responseChannelMarshal = args
 
             layerData = self.journal[snapshotId]['layers'][lyrId]
 
             ret = {}
             if 'active-columns' in fetches:
-                ret['active-columns'] = layerData['activeColumns']
+                putBits(ret, 'active-columns', layerData['activeColumns'],
+                        cachedOnscreenBits)
 
             if 'pred-columns' in fetches:
-                if 'predictedColumns' in layerData:
-                    ret['pred-columns'] = layerData['predictedColumns']
-                elif snapshotId > 0:
-                    prevLayerData = self.journal[snapshotId - 1]['layers'][lyrId]
-                    ret['pred-columns'] = prevLayerData['predictiveColumns']
+                predictedColumns = layerData.get('predictedColumns')
+                if predictedColumns is None:
+                    prevModelData = self.getPreviousTimestep(snapshotId)
+                    if prevModelData is not None:
+                        predictedColumns = (
+                            prevModelData['layers'][lyrId]['predictiveColumns'])
+                if predictedColumns is not None:
+                    putBits(ret, 'pred-columns', predictedColumns,
+                            cachedOnscreenBits)
 
             responseChannelMarshal.ch.put(ret)
 
@@ -447,13 +1110,55 @@ class Journal(object):
 
             ret = {}
             if 'active-bits' in fetches:
-                ret['active-bits'] = senseData['activeBits']
+                putBits(ret, 'active-bits', senseData['activeBits'],
+                        cachedOnscreenBits)
 
             responseChannelMarshal.ch.put(ret)
 
+        elif command == 'batch':
+            # Answer many requests with one response. Each request is a
+            # command and its arguments, without the response channel. The
+            # response is a list of the requests' responses, in order.
+            # Requests that have no response get None.
+            requests, responseChannelMarshal = args
+            responses = []
+            for request in requests:
+                if request[0] in NO_RESPONSE_COMMANDS:
+                    self.handleMessage(list(request))
+                    responses.append(None)
+                else:
+                    collector = ResponseCollector()
+                    self.handleMessage(list(request) +
+                                       [marshal.channel(collector)])
+                    responses.append(collector.response)
+
+            responseChannelMarshal.ch.put(responses)
+
         elif command == 'set-capture-options':
             captureOptions, = args
-            self.captureOptions = captureOptions
+            # Keep server-side options that the client doesn't know about.
+            self.captureOptions = mergeOptions(self.captureOptions,
+                                               captureOptions)
+            self.journal.setCapacity(self.captureOptions['keep-steps'])
+            self.compact()
+            self.enforceMemoryBudget()
+            self.discardStaleResponses()
+            self.saveHeader()
+
+        elif command == 'set-region-of-interest':
+            # The region is a list of columns, a {'start': s, 'stop': e}
+            # column range, or None to capture every column again. It applies
+            # to timesteps captured from now on.
+            lyrId, region = args
+            if lyrId not in self.networkShape['layers']:
+                print "Unrecognized layer! %s" % lyrId
+            elif region is None:
+                self.regionsOfInterest.pop(lyrId, None)
+            elif isinstance(region, collections.Mapping):
+                self.regionsOfInterest[lyrId] = frozenset(
+                    xrange(region['start'], region['stop']))
+            else:
+                self.regionsOfInterest[lyrId] = frozenset(region)
 
         else:
             print "Unrecognized command! %s" % command
@@ -475,12 +1180,9 @@ class Journal(object):
                             if state in synStates:
                                 syns = []
                                 for sourceBit, perm in synapses:
-                                    # TODO use synapse permanence from the
-                                    # beginning of the timestep. Otherwise we're
-                                    # calculating which synapses were active
-                                    # using the post-learning permanences. (Only
-                                    # in the visualization layer, not NuPIC
-                                    # itself)
+                                    # These are post-learning permanences
+                                    # unless the segments were captured with
+                                    # 'before-learning?'.
                                     syn = synapseTemplate.copy()
                                     syn.update({
                                         "src-i": sourceBit,
@@ -0,0 +1,86 @@
+from collections import Mapping
+
+import numpy as np
+
+
+class LazySegments(Mapping):
+    """
+    A compact copy of the segments and synapses of some columns, which acts
+    like a segsByColCell dict.
+
+    The synapses are classified and counted the first time they're needed,
+    e.g. when the snapshot's size is estimated, and stored as a
+    ClassifiedSegments. With background capture, that happens on the
+    CaptureWorker's thread rather than the model's. A column's segment
+    summaries are built the first time the column is looked up, and then
+    remembered.
+
+    Each cell's segments are a slice of the ClassifiedSegments, starting at
+    cellSegmentStarts.
+    """
+    def __init__(self, columns, cellIds, nSegmentsByCell, classify):
+        """
+        columns must be sorted. nSegmentsByCell has an entry for each of the
+        cellIds of each column, in order. classify returns the
+        ClassifiedSegments, and must not depend on the model's state.
+        """
+        self.columns = np.asarray(columns, dtype=np.uint32)
+        self.cellIds = list(cellIds)
+        self.cellSegmentStarts = np.zeros(len(nSegmentsByCell) + 1,
+                                          dtype=np.int64)
+        np.cumsum(nSegmentsByCell, out=self.cellSegmentStarts[1:])
+        self.classify = classify
+        self._classified = None
+        self.segsByColCell = {}
+
+    @property
+    def classified(self):
+        if self._classified is None:
+            self._classified = self.classify()
+            self.classify = None
+        return self._classified
+
+    @property
+    def nbytes(self):
+        return (self.columns.nbytes + self.cellSegmentStarts.nbytes +
+                self.classified.nbytes)
+
+    def __getstate__(self):
+        # Store the classified synapses, but not the built summaries.
+        state = self.__dict__.copy()
+        state['_classified'] = self.classified
+        state['classify'] = None
+        state['segsByColCell'] = {}
+        return state
+
+    def __len__(self):
+        return len(self.columns)
+
+    def __iter__(self):
+        for col in self.columns:
+            yield int(col)
+
+    def __contains__(self, col):
+        i = np.searchsorted(self.columns, col)
+        return i < len(self.columns) and self.columns[i] == col
+
+    def __getitem__(self, col):
+        segsByCell = self.segsByColCell.get(col)
+        if segsByCell is None:
+            if col not in self:
+                raise KeyError(col)
+            segsByCell = self.computeColumn(col)
+            self.segsByColCell[col] = segsByCell
+        return segsByCell
+
+    def computeColumn(self, col):
+        firstCell = np.searchsorted(self.columns, col) * len(self.cellIds)
+        segStarts = self.cellSegmentStarts[
+            firstCell:firstCell + len(self.cellIds) + 1].tolist()
+        summaries = self.classified.summaries(segStarts[0], segStarts[-1])
+
+        segsByCell = {}
+        for i, cell in enumerate(self.cellIds):
+            segsByCell[cell] = summaries[segStarts[i] - segStarts[0]:
+                                         segStarts[i + 1] - segStarts[0]]
+        return segsByCell
@@ -0,0 +1,58 @@
+import collections
+
+
+class LRUCache(object):
+    """
+    A mapping that holds at most maxEntries values, discarding the least
+    recently used value when it's full.
+
+    If maxBytes is set, values are also discarded while the total of the
+    sizes passed to put exceeds it. onDiscard is called with the key and value
+    of each discarded value.
+    """
+    def __init__(self, maxEntries, maxBytes=None, onDiscard=None):
+        assert maxEntries > 0
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.onDiscard = onDiscard
+        self.entries = collections.OrderedDict()
+        self.totalBytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        try:
+            value, nBytes = self.entries.pop(key)
+        except KeyError:
+            return default
+        self.entries[key] = (value, nBytes)
+        return value
+
+    def put(self, key, value, nBytes=0):
+        self.pop(key)
+        self.entries[key] = (value, nBytes)
+        self.totalBytes += nBytes
+        while (len(self.entries) > self.maxEntries or
+               (self.maxBytes is not None and self.totalBytes > self.maxBytes
+                and len(self.entries) > 1)):
+            oldestKey, (oldestValue, oldestBytes) = self.entries.popitem(
+                last=False)
+            self.totalBytes -= oldestBytes
+            if self.onDiscard is not None:
+                self.onDiscard(oldestKey, oldestValue)
+
+    def pop(self, key, default=None):
+        try:
+            value, nBytes = self.entries.pop(key)
+        except KeyError:
+            return default
+        self.totalBytes -= nBytes
+        return value
+
+    def clear(self):
+        self.entries.clear()
+        self.totalBytes = 0
@@ -100,6 +100,34 @@ def bigValue(value):
   """
   return BigValueMarshal(uuid.uuid1(), value)
 
+class PreEncodedMarshal(object):
+  def __init__(self, value):
+    self.value = value
+    self.encoded = None
+
+  def setEncoded(self, encoded):
+    self.encoded = encoded
+    # Only the encoding is needed from now on.
+    self.value = None
+
+def preEncoded(value):
+  """Returns a PreEncodedMarshal. It lets a value that's sent many times be
+  encoded only once.
+
+  The first time a PreEncodedMarshal is serialized, its value is encoded on its
+  own, without any of the sender's caches, and the encoding is saved on the
+  PreEncodedMarshal. Later messages splice in the saved encoding. Recipients
+  just see the value.
+
+  The value must not contain channels or other values whose encoding depends
+  on the connection.
+
+  All of this assumes that the network code on both clients is using
+  write-handlers and read-handlers that follow this protocol.
+
+  """
+  return PreEncodedMarshal(value)
+
 ##
 ## For networking
 ##
@@ -1,8 +1,14 @@
 from abc import ABCMeta, abstractmethod
-from collections import deque, Mapping
+from collections import Mapping
 
 import numpy as np
-from nupic.bindings.math import GetNTAReal
+
+from history import ConnectionsHistory, SegmentChangeTracker
+from extraction import (ClassifiedSegments, ConnectionsBackend,
+                        PotentialPools, SegmentSparseMatrixBackend,
+                        SpatialPoolerBackend, TPBackend, extractSegments,
+                        segmentsByColumnCell)
+from sdr import SDR
 
 class SanityModel(object):
     """
@@ -21,6 +27,11 @@ class SanityModel(object):
         self.listeners = {
             'didStep': {},
         }
+        # ConnectionsHistories by segment type. See
+        # recordConnectionsHistories.
+        self.connectionsHistories = {}
+        # IncrementalSegments by segment type.
+        self.segmentExtractors = {}
 
     def addEventListener(self, event, fn):
         eventId = self.lastEventIds[event] + 1
@@ -39,9 +50,86 @@ class SanityModel(object):
 
     def onStepped(self):
         self.timestep += 1
+        for history in self.connectionsHistories.values():
+            history.commit(self.timestep)
         for fn in self.listeners['didStep'].values():
             fn()
 
+    def getSegmentConnections(self):
+        """
+        Get the model's nupic.bindings Connections, keyed by segment type.
+        Models that return them support recordConnectionsHistories.
+
+        Returns
+        -------
+        dict
+          Example:
+            {
+                'distalSegments': tm.basalConnections,
+                'apicalSegments': tm.apicalConnections,
+            }
+        """
+        return {}
+
+    def recordConnectionsHistories(self, segmentsKeys):
+        """
+        Record the history of these segment types' Connections, and stop
+        recording any others. Only the segments that change are copied each
+        timestep.
+        """
+        connectionsByKey = self.getSegmentConnections()
+        for segmentsKey in segmentsKeys:
+            if (segmentsKey in connectionsByKey and
+                segmentsKey not in self.connectionsHistories):
+                self.connectionsHistories[segmentsKey] = ConnectionsHistory(
+                    connectionsByKey[segmentsKey], self.timestep)
+
+        for segmentsKey in self.connectionsHistories.keys():
+            if segmentsKey not in segmentsKeys:
+                self.connectionsHistories.pop(segmentsKey).close()
+
+    def getConnectionsBeforeLearning(self, segmentsKey, connections):
+        """
+        Return a read-only view of connections as they were at the beginning
+        of this timestep, before learning changed them, or return connections
+        if their history isn't being recorded.
+        """
+        history = self.connectionsHistories.get(segmentsKey)
+        if history is None or history.firstTimestep > self.timestep - 1:
+            return connections
+        return history.at(self.timestep - 1)
+
+    def extractSegments(self, segmentsKey, connections, tm, onlyColumns,
+                        activeBits, segmentsQuery, inputsAndWidths):
+        """
+        Summarize the segments of a nupic.bindings Connections, the way the
+        segments query asks. See the query method.
+        """
+        onlyActiveSynapses = segmentsQuery['onlyActiveSynapses']
+        onlyConnectedSynapses = segmentsQuery['onlyConnectedSynapses']
+        lazy = segmentsQuery.get('lazy', False)
+
+        if segmentsQuery.get('beforeLearning'):
+            connections = self.getConnectionsBeforeLearning(segmentsKey,
+                                                            connections)
+        elif segmentsQuery.get('incremental') and not lazy:
+            extractor = self.segmentExtractors.get(segmentsKey)
+            if extractor is None:
+                extractor = IncrementalSegments(connections)
+                self.segmentExtractors[segmentsKey] = extractor
+            return extractor.extract(tm, onlyColumns, activeBits,
+                                     onlyActiveSynapses,
+                                     onlyConnectedSynapses, inputsAndWidths)
+
+        if segmentsKey in self.segmentExtractors:
+            # Stop tracking changes.
+            self.segmentExtractors.pop(segmentsKey).close()
+
+        return segmentsFromConnections2(connections, tm, onlyColumns,
+                                        activeBits, onlyActiveSynapses,
+                                        onlyConnectedSynapses, inputsAndWidths,
+                                        lazy=lazy)
+
     @abstractmethod
     def step(self):
         """
@@ -81,6 +169,10 @@ class SanityModel(object):
             {
                 'onlyActiveSynapses': True,
                 'onlyConnectedSynapses': True,
+                # Optional. Only fetch segments for these columns of a layer.
+                'regionsOfInterest': {
+                    'layer-3': frozenset([10, 11, 12]),
+                },
             }
         distalSegmentsQuery : dict
           Details for the getDistalSegments.
@@ -90,6 +182,20 @@ class SanityModel(object):
                 'onlyConnectedSynapses': True,
                 # Open to interpretation. Recommended: active and predicted columns.
                 'onlyNoteworthyColumns': True,
+                # Optional. Only fetch segments for these columns of a layer.
+                'regionsOfInterest': {
+                    'layer-3': frozenset([10, 11, 12]),
+                },
+                # Optional. Return a LazySegments, which copies the
+                # synapses now, classifies them when they're first used, and
+                # builds each column's summaries when it's read.
+                'lazy': False,
+                # Optional. Use the synapse permanences from the beginning of
+                # the timestep. See getConnectionsBeforeLearning.
+                'beforeLearning': False,
+                # Optional. Reuse the previous timestep's summaries of
+                # segments that haven't changed. See IncrementalSegments.
+                'incremental': False,
             }
         apicalSegmentsQuery : dict
           Details for the getApicalSegments.
@@ -99,6 +205,20 @@ class SanityModel(object):
                 'onlyConnectedSynapses': True,
                 # Open to interpretation. Recommended: active and predicted columns.
                 'onlyNoteworthyColumns': True,
+                # Optional. Only fetch segments for these columns of a layer.
+                'regionsOfInterest': {
+                    'layer-3': frozenset([10, 11, 12]),
+                },
+                # Optional. Return a LazySegments, which copies the
+                # synapses now, classifies them when they're first used, and
+                # builds each column's summaries when it's read.
+                'lazy': False,
+                # Optional. Use the synapse permanences from the beginning of
+                # the timestep. See getConnectionsBeforeLearning.
+                'beforeLearning': False,
+                # Optional. Reuse the previous timestep's summaries of
+                # segments that haven't changed. See IncrementalSegments.
+                'incremental': False,
             }
 
         Returns
@@ -117,7 +237,7 @@ class SanityModel(object):
                     'dimensions': (200,),
 
                     # getBitStates
-                    'activeBits': set([159, 160, 161,])
+                    'activeBits': SDR([159, 160, 161,], 200)
                 }
             }
             'layers': {
@@ -128,10 +248,10 @@ class SanityModel(object):
                     'dimensions': (20,),
 
                     # getBitStates
-                    'activeCells': set([0, 1, 2,]),
-                    'activeColumns': set([0, 4, 5, 6, 9, 10,]),
-                    'predictedColumns': set([])
-                    'predictedCells': set([]),
+                    'activeCells': SDR([0, 1, 2,], 640),
+                    'activeColumns': SDR([0, 4, 5, 6, 9, 10,], 20),
+                    'predictedColumns': SDR([], 20)
+                    'predictedCells': SDR([], 640),
 
                     # getProximalSegments
                     'proximalSegments': {
@@ -168,7 +288,7 @@ class SanityModel(object):
                                             (4, 0.7100000381469727),
                                         ],
                                         'disconnected': [],
-                                        'inactive': [],
+                                        'inactive-syn': [],
                                     ]
                                 },
                             },
@@ -206,263 +326,135 @@ class SanityModel(object):
           ]
         """
 
-def proximalSegmentsFromSP(sp, activeBits, onlyActiveSynapses, onlyConnectedSynapses, sourcePath):
-    segsByColCell = {}
-    synPermConnected = sp.getSynPermConnected()
-    synapsePotentials = np.zeros(sp.getNumInputs()).astype('uint32')
-    synapsePermanences = np.zeros(sp.getNumInputs()).astype(GetNTAReal())
-    activeMask = np.zeros(sp.getNumInputs(), dtype=bool)
-    activeMask[list(activeBits)] = True
-    for column in range(sp.getNumColumns()):
-        segsByColCell[column] = {}
-
-        sp.getPotential(column, synapsePotentials)
-        potentialMask = synapsePotentials == 1
-
-        sp.getPermanence(column, synapsePermanences)
-        connectedMask = synapsePermanences >= synPermConnected
-
-        activeConnectedMask = activeMask & potentialMask & connectedMask
-        activeSyns = [(inputBit, synapsePermanences[inputBit])
-                      for inputBit in activeConnectedMask.nonzero()[0]]
-
-        inactiveSyns = []
-        if not onlyActiveSynapses:
-            inactiveConnectedMask = ~activeMask & potentialMask & connectedMask
-            inactiveSyns = [(inputBit, synapsePermanences[inputBit])
-                            for inputBit in inactiveConnectedMask.nonzero()[0]]
-
-        disconnectedSyns = []
-        if not onlyConnectedSynapses:
-            disconnectedMask = potentialMask & ~connectedMask
-            if onlyActiveSynapses:
-                disconnectedMask = disconnectedMask & activeMask
-            inactiveConnectedMask = ~activeMask & potentialMask & connectedMask
-            disconnectedSyns = [(inputBit, synapsePermanences[inputBit])
-                                for inputBit in inactiveConnectedMask.nonzero()[0]]
-
-        segsByColCell[column][-1] = [{
-            'synapses': {
-                sourcePath: {
-                    'active': activeSyns,
-                    'inactive': inactiveSyns,
-                    'disconnectedSyns': disconnectedSyns,
-                }
-            },
-        }]
+def columnsInRegion(columns, segmentsQuery, lyrId):
+    """
+    Narrow columns to the layer's region of interest, if the segments query
+    has one.
+    """
+    region = segmentsQuery.get('regionsOfInterest', {}).get(lyrId)
+    if region is None:
+        return columns
+    return [column for column in columns if column in region]
+
+
+def proximalSegmentsFromSP(sp, activeBits, onlyActiveSynapses, onlyConnectedSynapses, sourcePath,
+                           onlyColumns=None, potentialPools=None):
+    """
+    Extract the proximal segments of the selected columns as a LazySegments.
+    Each column has one segment, on cell -1.
+
+    Pass the sp's PotentialPools to avoid reading its potential pools. See
+    SpatialPoolerBackend.
+    """
+    if onlyColumns is None:
+        onlyColumns = xrange(sp.getNumColumns())
+    return extractSegments(SpatialPoolerBackend(sp, potentialPools),
+                           onlyColumns, activeBits, onlyActiveSynapses,
+                           onlyConnectedSynapses,
+                           [(sourcePath, sp.getNumInputs())], lazy=True)
 
-    return segsByColCell
 
 # TODO sourcePath is a hack
 def segmentsFromConnections(connections, tm, onlyColumns, activeBits,
                             sourcePath, onlyActiveSynapses,
-                            onlyConnectedSynapses, sourceCellOffset=0):
-    segsByColCell = {}
-    for col in onlyColumns:
-        segsByColCell[col] = {}
-        for cell in range(tm.getCellsPerColumn()):
-            segs = []
-            for seg in connections.segmentsForCell(col * tm.getCellsPerColumn() + cell):
-                activeSynapses = deque()
-                inactiveSynapses = deque()
-                disconnectedSynapses = deque()
-                nConnectedActive = 0
-                nConnectedTotal = 0
-                nDisconnectedActive = 0
-                nDisconnectedTotal = 0
-                for syn in connections.synapsesForSegment(seg):
-                    synapseData = connections.dataForSynapse(syn)
-
-                    # GeneralTemporalMemory describes apical targets
-                    # in terms of its own cell indices, not in terms
-                    # of a remote region.
-                    presynapticCell = synapseData.presynapticCell + sourceCellOffset
-
-                    isConnected = synapseData.permanence >= tm.getConnectedPermanence()
-                    isActive = presynapticCell in activeBits
-
-                    if isConnected:
-                        nConnectedTotal += 1
-                    else:
-                        nDisconnectedTotal += 1
-
-                    if isActive:
-                        if isConnected:
-                            nConnectedActive += 1
-                        else:
-                            nDisconnectedActive += 1
-
-                    synapseList = None
-                    if isActive and isConnected:
-                        synapseList = activeSynapses
-                    elif isConnected:
-                        if not onlyActiveSynapses:
-                            synapseList = inactiveSynapses
-                    else:
-                        if not onlyConnectedSynapses:
-                            synapseList = disconnectedSynapses
-
-                    if synapseList is not None:
-                        syn = (presynapticCell, synapseData.permanence)
-                        synapseList.append(syn)
-                segs.append({
-                    "synapses": {
-                        sourcePath: {
-                            'active': activeSynapses,
-                            'inactive-syn': inactiveSynapses,
-                            'disconnected': disconnectedSynapses,
-                        },
-                    },
-                    "nConnectedActive": nConnectedActive,
-                    "nConnectedTotal": nConnectedTotal,
-                    "nDisconnectedActive": nDisconnectedActive,
-                    "nDisconnectedTotal": nDisconnectedTotal,
-                })
-            segsByColCell[col][cell] = segs
-
-    return segsByColCell
+                            onlyConnectedSynapses, sourceCellOffset=0,
+                            lazy=False):
+    backend = ConnectionsBackend(connections, tm.getCellsPerColumn(),
+                                 tm.getConnectedPermanence(),
+                                 sourceCellOffset)
+    return extractSegments(backend, onlyColumns, activeBits,
+                           onlyActiveSynapses, onlyConnectedSynapses,
+                           [(sourcePath,
+                             connections.numCells() + sourceCellOffset)],
+                           lazy=lazy)
 
 
 def segmentsFromConnections2(connections, tm, onlyColumns, activeBits,
-                             onlyActiveSynapses, onlyConnectedSynapses, inputsAndWidths):
-    segsByColCell = {}
-    for col in onlyColumns:
-        segsByColCell[col] = {}
-        for cell in range(tm.getCellsPerColumn()):
-            segs = []
-            for seg in connections.segmentsForCell(col * tm.getCellsPerColumn() + cell):
-                nConnectedActive = 0
-                nConnectedTotal = 0
-                nDisconnectedActive = 0
-                nDisconnectedTotal = 0
-                synapsesBySource = {}
-
-                synapses = [connections.dataForSynapse(syn)
-                            for syn in connections.synapsesForSegment(seg)]
-                synapses = sorted(synapses, key=lambda a: a.presynapticCell)
-
-                offset = 0
-                synapseIdx = 0
-                for sourcePath, width in inputsAndWidths:
-                    activeSynapses = deque()
-                    inactiveSynapses = deque()
-                    disconnectedSynapses = deque()
-                    while (synapseIdx < len(synapses) and
-                           synapses[synapseIdx].presynapticCell < offset + width):
-                        synapseData = synapses[synapseIdx]
-
-                        isConnected = synapseData.permanence >= tm.getConnectedPermanence()
-                        isActive = synapseData.presynapticCell in activeBits
-
-                        if isConnected:
-                            nConnectedTotal += 1
-                        else:
-                            nDisconnectedTotal += 1
-
-                        if isActive:
-                            if isConnected:
-                                nConnectedActive += 1
-                            else:
-                                nDisconnectedActive += 1
-
-                        synapseList = None
-                        if isActive and isConnected:
-                            synapseList = activeSynapses
-                        elif isConnected:
-                            if not onlyActiveSynapses:
-                                synapseList = inactiveSynapses
-                        else:
-                            if not onlyConnectedSynapses:
-                                synapseList = disconnectedSynapses
-
-                        if synapseList is not None:
-                            syn = (synapseData.presynapticCell - offset, synapseData.permanence)
-                            synapseList.append(syn)
-
-                        synapseIdx += 1
-
-                    synapsesBySource[sourcePath] = {
-                        'active': activeSynapses,
-                        'inactive-syn': inactiveSynapses,
-                        'disconnected': disconnectedSynapses,
-                    }
-                    offset += width
-
-                segs.append({
-                    "synapses": synapsesBySource,
-                    "nConnectedActive": nConnectedActive,
-                    "nConnectedTotal": nConnectedTotal,
-                    "nDisconnectedActive": nDisconnectedActive,
-                    "nDisconnectedTotal": nDisconnectedTotal,
-                })
-            segsByColCell[col][cell] = segs
+                             onlyActiveSynapses, onlyConnectedSynapses, inputsAndWidths,
+                             lazy=False):
+    backend = ConnectionsBackend(connections, tm.getCellsPerColumn(),
+                                 tm.getConnectedPermanence())
+    return extractSegments(backend, onlyColumns, activeBits,
+                           onlyActiveSynapses, onlyConnectedSynapses,
+                           inputsAndWidths, lazy=lazy)
 
-    return segsByColCell
+
+class IncrementalSegments(object):
+    """
+    Extract segments like segmentsFromConnections2, reusing the summaries of
+    segments that haven't changed since the last extraction.
+
+    A segment is summarized again if it was created, destroyed or had its
+    synapses changed, which the Connections' events report, or if the activity
+    of one of its presynaptic cells changed. So the cost of each extraction
+    scales with the model's activity rather than its total number of
+    segments.
+    """
+    def __init__(self, connections):
+        self.connections = connections
+        self.tracker = SegmentChangeTracker(connections)
+        self.tracker.start()
+        self.summaries = {}
+        # The active bits and options that the summaries were made with.
+        self.activeBits = SDR()
+        self.summaryOptions = None
+
+    def close(self):
+        self.tracker.close()
+
+    def extract(self, tm, onlyColumns, activeBits, onlyActiveSynapses,
+                onlyConnectedSynapses, inputsAndWidths):
+        connections = self.connections
+        connectedPermanence = tm.getConnectedPermanence()
+        summaryOptions = (connectedPermanence, onlyActiveSynapses,
+                          onlyConnectedSynapses, tuple(inputsAndWidths))
+        activeBits = SDR(activeBits)
+
+        stale = self.tracker.takeDirty()
+        if summaryOptions != self.summaryOptions:
+            self.summaries.clear()
+            self.summaryOptions = summaryOptions
+        elif self.summaries:
+            changedBits = ((activeBits - self.activeBits) |
+                           (self.activeBits - activeBits))
+            for presynapticCell in changedBits:
+                for syn in connections.synapsesForPresynapticCell(presynapticCell):
+                    stale.add(connections.dataForSynapse(syn).segment)
+        for seg in stale:
+            self.summaries.pop(seg, None)
+        self.activeBits = activeBits
+
+        # Summarize the segments that don't have a summary all at once.
+        backend = ConnectionsBackend(connections, tm.getCellsPerColumn(),
+                                     connectedPermanence)
+        onlyColumns = sorted(onlyColumns)
+        nSegmentsByCell, segments = backend.segmentsForColumns(onlyColumns)
+        missing = [seg for seg in segments if seg not in self.summaries]
+        if missing:
+            segmentIds, presynapticCells, permanences = (
+                backend.gatherSynapses(missing))
+            classified = ClassifiedSegments(
+                len(missing), segmentIds, presynapticCells, permanences,
+                connectedPermanence, activeBits, onlyActiveSynapses,
+                onlyConnectedSynapses, inputsAndWidths)
+            self.summaries.update(zip(missing,
+                                      classified.summaries(0, len(missing))))
+
+        return segmentsByColumnCell(onlyColumns, backend.cellIds,
+                                    nSegmentsByCell,
+                                    [self.summaries[seg] for seg in segments])
 
 # TODO sourcePath is a hack
 def distalSegmentsFromTP(tp, onlyColumns, activeBits, sourcePath,
-                         onlyActiveSynapses, onlyConnectedSynapses):
-    segsByColCell = {}
-    for col in onlyColumns:
-        segsByColCell[col] = {}
-        for cell in range(tp.cellsPerColumn):
-            segs = []
-            for segIdx in range(tp.getNumSegmentsInCell(col, cell)):
-                v = tp.getSegmentOnCell(col, cell, segIdx)
-                segData = v[0]
-                activeSynapses = deque()
-                inactiveSynapses = deque()
-                disconnectedSynapses = deque()
-                nConnectedActive = 0
-                nConnectedTotal = 0
-                nDisconnectedActive = 0
-                nDisconnectedTotal = 0
-                for targetCol, targetCell, perm in v[1:]:
-                    cellId = targetCol * tp.cellsPerColumn + targetCell
-                    isConnected = perm >= tp.connectedPerm
-                    isActive = cellId in activeBits
-
-                    if isConnected:
-                        nConnectedTotal += 1
-                    else:
-                        nDisconnectedTotal += 1
-
-                    if isActive:
-                        if isConnected:
-                            nConnectedActive += 1
-                        else:
-                            nDisconnectedActive += 1
-
-                    synapseList = None
-                    if isActive and isConnected:
-                        synapseList = activeSynapses
-                    elif isConnected:
-                        if not onlyActiveSynapses:
-                            synapseList = inactiveSynapses
-                    else:
-                        if not onlyConnectedSynapses:
-                            synapseList = disconnectedSynapses
-
-                    if synapseList is not None:
-                        syn = (cellId, perm)
-                        synapseList.append(syn)
-
-                segs.append({
-                    "synapses": {
-                        sourcePath: {
-                            'active': activeSynapses,
-                            'inactive-syn': inactiveSynapses,
-                            'disconnected': disconnectedSynapses,
-                        },
-                    },
-                    "nConnectedActive": nConnectedActive,
-                    "nConnectedTotal": nConnectedTotal,
-                    "nDisconnectedActive": nDisconnectedActive,
-                    "nDisconnectedTotal": nDisconnectedTotal,
-                })
-            segsByColCell[col][cell] = segs
+                         onlyActiveSynapses, onlyConnectedSynapses,
+                         lazy=False):
+    # The presynaptic cells are the TP's own cells.
+    return extractSegments(TPBackend(tp), onlyColumns, activeBits,
+                           onlyActiveSynapses, onlyConnectedSynapses,
+                           [(sourcePath,
+                             tp.numberOfCols * tp.cellsPerColumn)],
+                           lazy=lazy)
 
-    return segsByColCell
 
 class CLASanityModel(SanityModel):
     """
@@ -473,6 +465,8 @@ class CLASanityModel(SanityModel):
     def __init__(self, model):
         super(CLASanityModel, self).__init__()
         self.model = model
+        # The SP's PotentialPools, read on the first proximal segments query.
+        self.potentialPools = None
 
     def query(self, bitHistory, getNetworkLayout=False, getBitStates=False,
               getProximalSegments=False, proximalSegmentsQuery={},
@@ -498,16 +492,19 @@ class CLASanityModel(SanityModel):
             })
 
         if getBitStates:
+            nColumns = sp.getNumColumns()
+            nCells = nColumns * tm.cellsPerColumn
             senses['concatenated'].update({
-                'activeBits': set(spRegion._spatialPoolerInput.nonzero()[0].tolist()),
+                'activeBits': SDR(spRegion._spatialPoolerInput.nonzero()[0],
+                                  sp.getNumInputs()),
             })
             npPredictedCells = tm.getPredictedState().reshape(-1).nonzero()[0]
             layers['layer-3'].update({
-                "activeColumns": set(spOutput.nonzero()[0].tolist()),
-                "activeCells": set(tm._getActiveState().nonzero()[0].tolist()),
-                "predictiveCells": set(npPredictedCells.tolist()),
-                "predictiveColumns": set(np.unique(npPredictedCells /
-                                                   tm.cellsPerColumn).tolist()),
+                "activeColumns": SDR(spOutput.nonzero()[0], nColumns),
+                "activeCells": SDR(tm._getActiveState().nonzero()[0], nCells),
+                "predictiveCells": SDR(npPredictedCells, nCells),
+                "predictiveColumns": SDR(npPredictedCells // tm.cellsPerColumn,
+                                         nColumns),
             })
 
         if getProximalSegments:
@@ -515,11 +512,18 @@ class CLASanityModel(SanityModel):
             onlyActiveSynapses = proximalSegmentsQuery['onlyActiveSynapses']
             onlyConnectedSynapses = proximalSegmentsQuery['onlyConnectedSynapses']
             sourcePath = ('senses', 'concatenated')
+            if self.potentialPools is None:
+                self.potentialPools = PotentialPools(sp)
             proximalSegments = proximalSegmentsFromSP(sp,
                                                       senses['concatenated']['activeBits'],
                                                       onlyActiveSynapses,
                                                       onlyConnectedSynapses,
-                                                      sourcePath)
+                                                      sourcePath,
+                                                      columnsInRegion(
+                                                          xrange(sp.getNumColumns()),
+                                                          proximalSegmentsQuery,
+                                                          'layer-3'),
+                                                      self.potentialPools)
 
             layers['layer-3'].update({
                 'proximalSegments': proximalSegments,
@@ -531,23 +535,27 @@ class CLASanityModel(SanityModel):
                 prevState = bitHistory.next()
                 columnsToCheck = (layers['layer-3']['activeColumns'] |
                                   prevState['layers']['layer-3']['predictiveColumns'])
+                columnsToCheck = columnsInRegion(columnsToCheck, distalSegmentsQuery, 'layer-3')
                 onlySources = prevState['layers']['layer-3']['activeCells']
                 sourcePath = ('layers', 'layer-3')
                 onlyActiveSynapses = distalSegmentsQuery['onlyActiveSynapses']
                 onlyConnectedSynapses = distalSegmentsQuery['onlyConnectedSynapses']
+                lazy = distalSegmentsQuery.get('lazy', False)
                 if hasattr(tm, "connections"):
                     distalSegments = segmentsFromConnections(tm.connections, tm,
                                                              columnsToCheck,
                                                              onlySources,
                                                              sourcePath,
                                                              onlyActiveSynapses,
-                                                             onlyConnectedSynapses)
+                                                             onlyConnectedSynapses,
+                                                             lazy=lazy)
                 else:
                     distalSegments = distalSegmentsFromTP(tm, columnsToCheck,
                                                           onlySources,
                                                           sourcePath,
                                                           onlyActiveSynapses,
-                                                          onlyConnectedSynapses)
+                                                          onlyConnectedSynapses,
+                                                          lazy=lazy)
                 layers['layer-3'].update({
                     'distalSegments': distalSegments,
                     "nDistalLearningThreshold": tm.minThreshold,
@@ -572,6 +580,12 @@ class ExtendedTemporalMemorySanityModel(SanityModel):
         self.activeExternalCellsBasal = []
         self.activeExternalCellsApical = []
 
+    def getSegmentConnections(self):
+        return {
+            'distalSegments': self.tm.basalConnections,
+            'apicalSegments': self.tm.apicalConnections,
+        }
+
     def query(self, bitHistory, getNetworkLayout=False, getBitStates=False,
               getProximalSegments=False, proximalSegmentsQuery={},
               getDistalSegments=False, distalSegmentsQuery={},
@@ -606,22 +620,29 @@ class ExtendedTemporalMemorySanityModel(SanityModel):
 
         if getBitStates:
             senses['external'].update({
-                'activeBits': set(self.activeExternalCellsBasal)
+                'activeBits': SDR(self.activeExternalCellsBasal,
+                                  tm.getBasalInputSize())
             })
 
-            predictedCells = tm.getPredictedCells()
+            nColumns = tm.numberOfColumns()
+            nCells = tm.numberOfCells()
+            predictedCells = np.asarray(tm.getPredictedCells())
             layers['tm'].update({
-                'activeColumns': set(self.activeColumns),
-                'activeCells': set(tm.getActiveCells()),
-                'predictedCells': set(predictedCells),
-                'predictedColumns': set(predictedCells / tm.getCellsPerColumn()),
+                'activeColumns': SDR(self.activeColumns, nColumns),
+                'activeCells': SDR(tm.getActiveCells(), nCells),
+                'predictedCells': SDR(predictedCells, nCells),
+                'predictedColumns': SDR(predictedCells // tm.getCellsPerColumn(),
+                                        nColumns),
             })
 
+            nApicalInputs = tm.getApicalInputSize()
+            activeApicalInputs = SDR(self.activeExternalCellsApical,
+                                     nApicalInputs)
             layers['higher'].update({
-                'activeColumns': set(self.activeExternalCellsApical),
-                'activeCells': set(self.activeExternalCellsApical),
-                'predictedCells': set(),
-                'predictedColumns': set(),
+                'activeColumns': activeApicalInputs,
+                'activeCells': activeApicalInputs,
+                'predictedCells': SDR((), nApicalInputs),
+                'predictedColumns': SDR((), nApicalInputs),
             })
 
         if getDistalSegments or getApicalSegments:
@@ -635,19 +656,17 @@ class ExtendedTemporalMemorySanityModel(SanityModel):
                                           layers['tm']['predictedColumns'])
                     else:
                         columnsToCheck = xrange(self.tm.numberOfColumns())
+                    columnsToCheck = columnsInRegion(columnsToCheck, distalSegmentsQuery, 'tm')
 
                     activeBits = senses['external']['activeBits']
 
                     inputsAndWidths = [
                         (('senses', 'external'), tm.getBasalInputSize())
                     ]
-                    onlyActiveSynapses = distalSegmentsQuery['onlyActiveSynapses']
-                    onlyConnectedSynapses = distalSegmentsQuery['onlyConnectedSynapses']
-                    distalSegments = segmentsFromConnections2(tm.basalConnections, tm,
-                                                              columnsToCheck, activeBits,
-                                                              onlyActiveSynapses,
-                                                              onlyConnectedSynapses,
-                                                              inputsAndWidths)
+                    distalSegments = self.extractSegments(
+                        'distalSegments', tm.basalConnections, tm,
+                        columnsToCheck, activeBits, distalSegmentsQuery,
+                        inputsAndWidths)
                     layers['tm'].update({
                         'distalSegments': distalSegments,
                         "nDistalLearningThreshold": tm.getMinThreshold(),
@@ -659,24 +678,23 @@ class ExtendedTemporalMemorySanityModel(SanityModel):
                                           layers['tm']['predictedColumns'])
                     else:
                         columnsToCheck = xrange(self.tm.numberOfColumns())
+                    columnsToCheck = columnsInRegion(columnsToCheck, apicalSegmentsQuery, 'tm')
 
-                    activeBits = prevState['layers']['tm']['activeCells']
-
-                    activeBits.update(cell + tm.numberOfCells()
-                                      for cell in prevState['layers']['higher']['activeCells'])
+                    prevApicalCells = prevState['layers']['higher']['activeCells']
+                    nCells = tm.numberOfCells()
+                    activeBits = (prevState['layers']['tm']['activeCells'] |
+                                  SDR(prevApicalCells.indices + nCells,
+                                      nCells + tm.getApicalInputSize()))
 
                     sourceCellsPerColumn = 1
                     inputsAndWidths = [
                         (('layers', 'higher'), tm.getApicalInputSize()) # TODO
                     ]
                     sourceCellOffset = -tm.numberOfCells()
-                    onlyActiveSynapses = apicalSegmentsQuery['onlyActiveSynapses']
-                    onlyConnectedSynapses = apicalSegmentsQuery['onlyConnectedSynapses']
-                    apicalSegments = segmentsFromConnections2(tm.apicalConnections, tm,
-                                                              columnsToCheck, activeBits,
-                                                              onlyActiveSynapses,
-                                                              onlyConnectedSynapses,
-                                                              inputsAndWidths)
+                    apicalSegments = self.extractSegments(
+                        'apicalSegments', tm.apicalConnections, tm,
+                        columnsToCheck, activeBits, apicalSegmentsQuery,
+                        inputsAndWidths)
                     layers['tm'].update({
                         'apicalSegments': apicalSegments,
                         "nApicalLearningThreshold": tm.getMinThreshold(),
@@ -700,6 +718,11 @@ class TemporalMemorySanityModel(SanityModel):
         self.activeExternalCellsBasal = []
         self.activeExternalCellsApical = []
 
+    def getSegmentConnections(self):
+        return {
+            'distalSegments': self.tm.connections,
+        }
+
     def query(self, bitHistory, getNetworkLayout=False, getBitStates=False,
               getProximalSegments=False, proximalSegmentsQuery={},
               getDistalSegments=False, distalSegmentsQuery={},
@@ -720,13 +743,15 @@ class TemporalMemorySanityModel(SanityModel):
             })
 
         if getBitStates:
-            predictiveCells = set(tm.getPredictiveCells())
-            predictiveColumns = set(cell / tm.getCellsPerColumn() for cell in predictiveCells)
+            nColumns = tm.numberOfColumns()
+            nCells = tm.numberOfCells()
+            npPredictiveCells = np.asarray(tm.getPredictiveCells())
             layers['tm'].update({
-                'activeColumns': set(self.activeColumns),
-                'activeCells': set(tm.getActiveCells()),
-                'predictiveCells': predictiveCells,
-                'predictiveColumns': predictiveColumns,
+                'activeColumns': SDR(self.activeColumns, nColumns),
+                'activeCells': SDR(tm.getActiveCells(), nCells),
+                'predictiveCells': SDR(npPredictiveCells, nCells),
+                'predictiveColumns': SDR(npPredictiveCells // tm.getCellsPerColumn(),
+                                         nColumns),
             })
 
         if getDistalSegments:
@@ -739,19 +764,17 @@ class TemporalMemorySanityModel(SanityModel):
                                       prevState['layers']['tm']['predictiveColumns'])
                 else:
                     columnsToCheck = xrange(self.tm.numberOfColumns())
+                columnsToCheck = columnsInRegion(columnsToCheck, distalSegmentsQuery, 'tm')
 
                 activeBits = prevState['layers']['tm']['activeCells']
 
                 inputsAndWidths = [
                     (('layers', 'tm'), tm.numberOfCells()),
                 ]
-                onlyActiveSynapses = distalSegmentsQuery['onlyActiveSynapses']
-                onlyConnectedSynapses = distalSegmentsQuery['onlyConnectedSynapses']
-                distalSegments = segmentsFromConnections2(tm.connections, tm,
-                                                          columnsToCheck, activeBits,
-                                                          onlyActiveSynapses,
-                                                          onlyConnectedSynapses,
-                                                          inputsAndWidths)
+                distalSegments = self.extractSegments(
+                    'distalSegments', tm.connections, tm,
+                    columnsToCheck, activeBits, distalSegmentsQuery,
+                    inputsAndWidths)
                 layers['tm'].update({
                     'distalSegments': distalSegments,
                     "nDistalLearningThreshold": tm.getMinThreshold(),
@@ -769,80 +792,13 @@ class TemporalMemorySanityModel(SanityModel):
 
 def segmentsFromSegmentSparseMatrix(
         connections, tm, onlyColumns, activeBits,
-        onlyActiveSynapses, onlyConnectedSynapses, inputsAndWidths):
-    segsByColCell = {}
-    for col in onlyColumns:
-        segsByColCell[col] = {}
-        for cell in range(tm.cellsPerColumn):
-            segs = []
-            for seg in connections.getSegmentsForCell(col * tm.cellsPerColumn + cell):
-                nConnectedActive = 0
-                nConnectedTotal = 0
-                nDisconnectedActive = 0
-                nDisconnectedTotal = 0
-                synapsesBySource = {}
-
-                row = connections.matrix.getRow(seg)
-                presynapticCells = np.flatnonzero(row)
-
-                offset = 0
-                synapseIdx = 0
-                for sourcePath, width in inputsAndWidths:
-                    activeSynapses = deque()
-                    inactiveSynapses = deque()
-                    disconnectedSynapses = deque()
-                    while (synapseIdx < len(presynapticCells) and
-                           presynapticCells[synapseIdx] < offset + width):
-                        presynapticCell = presynapticCells[synapseIdx]
-                        permanence = row[presynapticCell]
-
-                        isConnected = permanence >= tm.connectedPermanence
-                        isActive = presynapticCell in activeBits
-
-                        if isConnected:
-                            nConnectedTotal += 1
-                        else:
-                            nDisconnectedTotal += 1
-
-                        if isActive:
-                            if isConnected:
-                                nConnectedActive += 1
-                            else:
-                                nDisconnectedActive += 1
-
-                        synapseList = None
-                        if isActive and isConnected:
-                            synapseList = activeSynapses
-                        elif isConnected:
-                            if not onlyActiveSynapses:
-                                synapseList = inactiveSynapses
-                        else:
-                            if not onlyConnectedSynapses:
-                                synapseList = disconnectedSynapses
-
-                        if synapseList is not None:
-                            syn = (presynapticCell - offset, permanence)
-                            synapseList.append(syn)
-
-                        synapseIdx += 1
-
-                    synapsesBySource[sourcePath] = {
-                        'active': activeSynapses,
-                        'inactive-syn': inactiveSynapses,
-                        'disconnected': disconnectedSynapses,
-                    }
-                    offset += width
-
-                segs.append({
-                    "synapses": synapsesBySource,
-                    "nConnectedActive": nConnectedActive,
-                    "nConnectedTotal": nConnectedTotal,
-                    "nDisconnectedActive": nDisconnectedActive,
-                    "nDisconnectedTotal": nDisconnectedTotal,
-                })
-            segsByColCell[col][cell] = segs
-
-    return segsByColCell
+        onlyActiveSynapses, onlyConnectedSynapses, inputsAndWidths,
+        lazy=False):
+    backend = SegmentSparseMatrixBackend(connections, tm.cellsPerColumn,
+                                         tm.connectedPermanence)
+    return extractSegments(backend, onlyColumns, activeBits,
+                           onlyActiveSynapses, onlyConnectedSynapses,
+                           inputsAndWidths, lazy=lazy)
 
 
 
@@ -874,12 +830,14 @@ class SMTMSequenceSanityModel(SanityModel):
             })
 
         if getBitStates:
-            predictedCells = tm.getPredictedCells()
+            nCells = tm.columnCount * tm.cellsPerColumn
+            predictedCells = np.asarray(tm.getPredictedCells())
             layers['tm'].update({
-                'activeColumns': set(self.activeColumns),
-                'activeCells': set(tm.activeCells),
-                'predictedCells': set(predictedCells),
-                'predictedColumns': set(predictedCells / tm.cellsPerColumn),
+                'activeColumns': SDR(self.activeColumns, tm.columnCount),
+                'activeCells': SDR(tm.activeCells, nCells),
+                'predictedCells': SDR(predictedCells, nCells),
+                'predictedColumns': SDR(predictedCells // tm.cellsPerColumn,
+                                        tm.columnCount),
             })
 
         if getDistalSegments:
@@ -892,6 +850,7 @@ class SMTMSequenceSanityModel(SanityModel):
                                       layers['tm']['predictedColumns'])
                 else:
                     columnsToCheck = xrange(self.tm.columnCount)
+                columnsToCheck = columnsInRegion(columnsToCheck, distalSegmentsQuery, 'tm')
 
                 activeBits = prevState['layers']['tm']['activeCells']
 
@@ -906,7 +865,8 @@ class SMTMSequenceSanityModel(SanityModel):
                     columnsToCheck, activeBits,
                     onlyActiveSynapses,
                     onlyConnectedSynapses,
-                    inputsAndWidths)
+                    inputsAndWidths,
+                    lazy=distalSegmentsQuery.get('lazy', False))
                 layers['tm'].update({
                     'distalSegments': distalSegments,
                     "nDistalLearningThreshold": tm.minThreshold,
@@ -965,22 +925,28 @@ class SMTMExternalSanityModel(SanityModel):
 
         if getBitStates:
             senses['external'].update({
-                'activeBits': set(self.activeExternalCellsBasal)
+                'activeBits': SDR(self.activeExternalCellsBasal,
+                                  tm.basalConnections.matrix.nCols())
             })
 
-            predictedCells = tm.getPredictedCells()
+            nCells = tm.columnCount * tm.cellsPerColumn
+            predictedCells = np.asarray(tm.getPredictedCells())
             layers['tm'].update({
-                'activeColumns': set(self.activeColumns),
-                'activeCells': set(tm.getActiveCells()),
-                'predictedCells': set(predictedCells),
-                'predictedColumns': set(predictedCells / tm.cellsPerColumn),
+                'activeColumns': SDR(self.activeColumns, tm.columnCount),
+                'activeCells': SDR(tm.getActiveCells(), nCells),
+                'predictedCells': SDR(predictedCells, nCells),
+                'predictedColumns': SDR(predictedCells // tm.cellsPerColumn,
+                                        tm.columnCount),
             })
 
+            nApicalInputs = tm.apicalConnections.matrix.nCols()
+            activeApicalInputs = SDR(self.activeExternalCellsApical,
+                                     nApicalInputs)
             layers['higher'].update({
-                'activeColumns': set(self.activeExternalCellsApical),
-                'activeCells': set(self.activeExternalCellsApical),
-                'predictedCells': set(),
-                'predictedColumns': set(),
+                'activeColumns': activeApicalInputs,
+                'activeCells': activeApicalInputs,
+                'predictedCells': SDR((), nApicalInputs),
+                'predictedColumns': SDR((), nApicalInputs),
             })
 
         if getDistalSegments or getApicalSegments:
@@ -994,6 +960,7 @@ class SMTMExternalSanityModel(SanityModel):
                                           layers['tm']['predictedColumns'])
                     else:
                         columnsToCheck = xrange(self.tm.columnCount)
+                    columnsToCheck = columnsInRegion(columnsToCheck, distalSegmentsQuery, 'tm')
 
                     activeBits = senses['external']['activeBits']
 
@@ -1007,7 +974,8 @@ class SMTMExternalSanityModel(SanityModel):
                         columnsToCheck, activeBits,
                         onlyActiveSynapses,
                         onlyConnectedSynapses,
-                        inputsAndWidths)
+                        inputsAndWidths,
+                        lazy=distalSegmentsQuery.get('lazy', False))
                     layers['tm'].update({
                         'distalSegments': distalSegments,
                         "nDistalLearningThreshold": tm.minThreshold,
@@ -1019,6 +987,7 @@ class SMTMExternalSanityModel(SanityModel):
                                           layers['tm']['predictedColumns'])
                     else:
                         columnsToCheck = xrange(self.tm.columnCount)
+                    columnsToCheck = columnsInRegion(columnsToCheck, apicalSegmentsQuery, 'tm')
 
                     activeBits = layers['higher']['activeCells']
 
@@ -1034,7 +1003,8 @@ class SMTMExternalSanityModel(SanityModel):
                         columnsToCheck, activeBits,
                         onlyActiveSynapses,
                         onlyConnectedSynapses,
-                        inputsAndWidths)
+                        inputsAndWidths,
+                        lazy=apicalSegmentsQuery.get('lazy', False))
                     layers['tm'].update({
                         'apicalSegments': apicalSegments,
                         "nApicalLearningThreshold": tm.minThreshold,
@@ -1056,6 +1026,8 @@ class SPTMModel(SanityModel):
         super(SPTMModel, self).__init__()
         self.sp = sp
         self.tm = tm
+        # The SP's PotentialPools, read when they're first needed.
+        self.potentialPools = None
         self.inputDisplayText = ""
         self.activeInputs = ()
         self.activeColumns = ()
@@ -1073,6 +1045,18 @@ class SPTMModel(SanityModel):
             return self.inputDisplayText
 
 
+    def getPotentialPools(self):
+        if self.potentialPools is None:
+            self.potentialPools = PotentialPools(self.sp)
+        return self.potentialPools
+
+
+    def getSegmentConnections(self):
+        return {
+            'distalSegments': self.tm.connections,
+        }
+
+
     def query(self, bitHistory, getNetworkLayout=False, getBitStates=False,
               getProximalSegments=False, proximalSegmentsQuery={},
               getDistalSegments=False, distalSegmentsQuery={},
@@ -1101,16 +1085,20 @@ class SPTMModel(SanityModel):
 
         if getBitStates:
             senses['concatenated'].update({
-                'activeBits': set(self.activeInputs)
+                'activeBits': SDR(self.activeInputs, sp.getNumInputs())
             })
 
-            predictedColumns = set(cell / tm.getCellsPerColumn()
-                                   for cell in self.predictedCells)
+            nColumns = sp.getNumColumns()
+            nCells = tm.numberOfCells()
+            # appendTimestep accepts any iterable of cells.
+            predictedCells = SDR(self.predictedCells, nCells)
             layers['sp+tm'].update({
-                'activeColumns': set(self.activeColumns),
-                'activeCells': set(tm.getActiveCells()),
-                'predictedCells': set(self.predictedCells),
-                'predictedColumns': predictedColumns,
+                'activeColumns': SDR(self.activeColumns, nColumns),
+                'activeCells': SDR(tm.getActiveCells(), nCells),
+                'predictedCells': predictedCells,
+                'predictedColumns': SDR(
+                    predictedCells.indices // tm.getCellsPerColumn(),
+                    nColumns),
             })
 
         if getProximalSegments:
@@ -1120,7 +1108,10 @@ class SPTMModel(SanityModel):
             proximalSegments = proximalSegmentsFromSP(
                 sp, senses['concatenated']['activeBits'],
                 onlyActiveSynapses, onlyConnectedSynapses,
-                sourcePath)
+                sourcePath,
+                columnsInRegion(xrange(sp.getNumColumns()),
+                                proximalSegmentsQuery, 'sp+tm'),
+                self.getPotentialPools())
 
             layers['sp+tm'].update({
                 'proximalSegments': proximalSegments,
@@ -1136,19 +1127,16 @@ class SPTMModel(SanityModel):
                         layers['sp+tm']['predictedColumns'])
                 else:
                     columnsToCheck = xrange(sp.getNumColumns())
+                columnsToCheck = columnsInRegion(columnsToCheck, distalSegmentsQuery, 'sp+tm')
 
                 activeBits = prevState['layers']['sp+tm']['activeCells']
 
                 inputsAndWidths = [
                     (('layers', 'sp+tm'), tm.numberOfCells()),
                 ]
-                onlyActiveSynapses = distalSegmentsQuery['onlyActiveSynapses']
-                onlyConnectedSynapses = distalSegmentsQuery['onlyConnectedSynapses']
-                distalSegments = segmentsFromConnections2(
-                    tm.connections, tm,
-                    columnsToCheck, activeBits,
-                    onlyActiveSynapses,
-                    onlyConnectedSynapses,
+                distalSegments = self.extractSegments(
+                    'distalSegments', tm.connections, tm,
+                    columnsToCheck, activeBits, distalSegmentsQuery,
                     inputsAndWidths)
 
                 layers['sp+tm'].update({
@@ -0,0 +1,108 @@
+from journal import Journal, mergeOptions
+from snapshots import DiskSnapshotRingBuffer
+
+
+class RecordingSanityModel(object):
+    """
+    Step through a journal that was recorded with the 'disk' storage mode,
+    rather than running an HTM.
+
+    The recording's directory is the one given in the 'storage' capture
+    option. Stepping moves a cursor through the recorded snapshots, and seek
+    moves it to any snapshot without replaying the ones before it. Either way,
+    the 'didStep' listeners are told. Stepping past the last snapshot stays
+    on it and tells the 'didReachEnd' listeners instead, so a seek back can
+    be followed by more steps.
+
+    This stands in for a SanityModel in a SanityRunner, but it can't be
+    queried. The ReplayJournal reads the recording directly.
+    """
+    def __init__(self, directory, cacheSize=8):
+        self.snapshots = DiskSnapshotRingBuffer(1, directory,
+                                                cacheSize=cacheSize,
+                                                readOnly=True)
+        self.header = self.snapshots.header
+        # The first step moves to the first snapshot.
+        self.snapshotId = -1
+
+        self.lastEventIds = {
+            'didStep': 0,
+            'didReachEnd': 0,
+        }
+        self.listeners = {
+            'didStep': {},
+            'didReachEnd': {},
+        }
+
+    def addEventListener(self, event, fn):
+        eventId = self.lastEventIds[event] + 1
+        self.listeners[event][eventId] = fn
+        self.lastEventIds[event] = eventId
+
+    def removeEventListener(self, event, eventId):
+        del self.listeners[event][eventId]
+
+    def doStep(self):
+        return self.step()
+
+    def step(self):
+        """
+        Move to the next snapshot. At the end of the recording, stay on the
+        last snapshot.
+
+        This never returns False, because that would stop the simulation
+        thread for good.
+        """
+        if self.snapshotId + 1 >= self.snapshots.nextSnapshotId:
+            for fn in self.listeners['didReachEnd'].values():
+                fn()
+            return
+        self.snapshotId += 1
+        self.onStepped()
+
+    def seek(self, snapshotId):
+        self.snapshots.checkAvailable(snapshotId)
+        self.snapshotId = snapshotId
+        self.onStepped()
+
+    def onStepped(self):
+        for fn in self.listeners['didStep'].values():
+            fn()
+
+    def getInputDisplayText(self):
+        return self.snapshots[self.snapshotId]['step']['display-value']
+
+
+class ReplayJournal(Journal):
+    """
+    A Journal that serves a RecordingSanityModel's recorded snapshots over the
+    usual journal protocol.
+
+    When the recording steps or seeks, subscribers are sent the recorded step.
+    """
+    def __init__(self, recording):
+        self.recording = recording
+        self.initState(recording.header['capture-options'],
+                       recording.header['network-shape'],
+                       recording.snapshots)
+
+        recording.addEventListener('didStep', self.onRecordingStepped)
+
+    def onRecordingStepped(self):
+        self.notify(self.journal[self.recording.snapshotId]['step'])
+
+    def handleCommand(self, command, args):
+        if command == 'seek':
+            snapshotId, = args
+            if snapshotId in self.journal:
+                self.recording.seek(snapshotId)
+            else:
+                print "Can't seek to unknown snapshot %s" % snapshotId
+        elif command == 'set-capture-options':
+            # The recording is read-only. Remember the options, but don't
+            # compact or evict anything.
+            captureOptions, = args
+            self.captureOptions = mergeOptions(self.captureOptions,
+                                               captureOptions)
+        else:
+            super(ReplayJournal, self).handleCommand(command, args)
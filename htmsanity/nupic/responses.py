@@ -0,0 +1,71 @@
+import collections
+
+from lru import LRUCache
+
+
+def freeze(v):
+    """
+    Convert a request's arguments into a hashable value, for use as a key.
+    """
+    if isinstance(v, collections.Mapping):
+        return frozenset((freeze(k), freeze(v2)) for k, v2 in v.items())
+    elif isinstance(v, (set, frozenset)):
+        return frozenset(freeze(v2) for v2 in v)
+    elif isinstance(v, (list, tuple)):
+        return tuple(freeze(v2) for v2 in v)
+    else:
+        return v
+
+
+class ResponseCache(object):
+    """
+    Recent responses to journal requests, keyed by command, snapshot and
+    query, and discarded when their snapshot changes.
+
+    The responses hold PreEncodedMarshals, so a cached response also skips
+    the transit encoding. The cache's size is limited by the estimated size
+    of the responses.
+    """
+    def __init__(self, maxBytes, maxEntries=4096):
+        self.entries = LRUCache(maxEntries, maxBytes, self.onDiscard)
+        self.keysBySnapshot = collections.defaultdict(set)
+        self.nHits = 0
+        self.nMisses = 0
+
+    def put(self, key, snapshotId, response, nBytes):
+        self.keysBySnapshot[snapshotId].add(key)
+        self.entries.put(key, (snapshotId, response), nBytes)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.nMisses += 1
+            return None
+        self.nHits += 1
+        _, response = entry
+        return response
+
+    def onDiscard(self, key, entry):
+        snapshotId, _ = entry
+        keys = self.keysBySnapshot[snapshotId]
+        keys.discard(key)
+        if not keys:
+            del self.keysBySnapshot[snapshotId]
+
+    def invalidate(self, snapshotId):
+        """Discard every response about a snapshot."""
+        for key in self.keysBySnapshot.pop(snapshotId, ()):
+            self.entries.pop(key)
+
+    def invalidateMissing(self, snapshots):
+        """Discard every response about a snapshot that's not in snapshots."""
+        for staleId in [i for i in self.keysBySnapshot if i not in snapshots]:
+            self.invalidate(staleId)
+
+    def getStats(self):
+        return {
+            'bytes': self.entries.totalBytes,
+            'entries': len(self.entries),
+            'hits': self.nHits,
+            'misses': self.nMisses,
+        }
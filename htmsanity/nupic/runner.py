@@ -15,6 +15,7 @@ from twisted.python import log
 import marshalling as marshal
 from simulation import Simulation
 from journal import Journal
+from replay import RecordingSanityModel, ReplayJournal
 from model import (CLASanityModel, TemporalMemorySanityModel,
                    SMTMSequenceSanityModel, SMTMExternalSanityModel,
                    ExtendedTemporalMemorySanityModel, SPTMModel)
@@ -86,8 +87,15 @@ def makeRunnerRequestHandler(websocketPort, selectedTab):
 
 class SanityRunner(object):
     def __init__(self, sanityModel, captureOptions=None, startSimThread=True):
-        self.journal = Journal(sanityModel, captureOptions)
+        if isinstance(sanityModel, RecordingSanityModel):
+            self.journal = ReplayJournal(sanityModel)
+        else:
+            self.journal = Journal(sanityModel, captureOptions)
         self.simulation = Simulation(sanityModel, startSimThread)
+        if isinstance(sanityModel, RecordingSanityModel):
+            # Pause at the end of the recording, rather than spinning.
+            sanityModel.addEventListener(
+                'didReachEnd', lambda: self.simulation.handleMessage(['pause']))
         self.localTargets = {
             'simulation': marshal.channel(self.simulation),
             'journal': marshal.channel(self.journal),
@@ -126,6 +134,19 @@ class SanityRunner(object):
             reactor.run()
 
 
+def replay(directory, launchBrowser=True, selectedTab="drawing"):
+    """
+    Explore a journal recorded with the 'disk' storage mode. No HTM is needed.
+
+    Stepping the simulation moves forward through the recording. To jump to a
+    snapshot, send the journal a ['seek', snapshotId] message.
+    """
+    sanityModel = RecordingSanityModel(directory)
+    runner = SanityRunner(sanityModel)
+    runner.start(launchBrowser=launchBrowser, selectedTab=selectedTab)
+    return runner
+
+
 class SPTMInstance(object):
     """
     Rather that patching a model class, treat Sanity as a logger.
@@ -0,0 +1,196 @@
+import numpy as np
+
+
+class SDR(object):
+    """
+    An immutable set of active bit indices, stored compactly.
+
+    Sparse SDRs are stored as a sorted uint32 array of indices. When more than
+    1/32 of the bits are active and the SDR's size is known, a packed bitset is
+    smaller, so it's stored that way instead.
+
+    SDRs support the set operations used by the journal (|, &, -, len, in,
+    iteration), implemented with NumPy rather than Python sets. The result of
+    an operation is sized to hold the bits of both operands.
+
+    Every index must be less than size. An SDR without a size accepts any
+    index.
+    """
+    __slots__ = ('size', 'nActive', '_indices', '_bits')
+
+    def __init__(self, indices=(), size=None):
+        if isinstance(indices, SDR):
+            if size is None:
+                size = indices.size
+            indices = indices.indices
+        elif isinstance(indices, np.ndarray):
+            indices = np.unique(indices.astype(np.uint32, copy=False))
+        else:
+            indices = np.unique(np.fromiter(indices, dtype=np.uint32))
+
+        if size is not None and indices.size > 0 and indices[-1] >= size:
+            raise ValueError("Bit %d is out of range for an SDR of size %d"
+                             % (indices[-1], size))
+
+        self.size = size
+        self.nActive = indices.size
+
+        if size is not None and self.nActive * 32 > size:
+            mask = np.zeros(size, dtype=bool)
+            mask[indices] = True
+            self._bits = np.packbits(mask)
+            self._indices = None
+        else:
+            self._bits = None
+            self._indices = indices
+
+    @property
+    def indices(self):
+        """The active bits, as a sorted uint32 array."""
+        if self._indices is not None:
+            return self._indices
+        else:
+            mask = np.unpackbits(self._bits)[:self.size]
+            return np.flatnonzero(mask).astype(np.uint32)
+
+    @property
+    def nbytes(self):
+        if self._indices is not None:
+            return self._indices.nbytes
+        else:
+            return self._bits.nbytes
+
+    def mask(self, size=None):
+        """Returns a dense boolean array with the active bits set."""
+        if size is None:
+            size = self.size
+        if self._bits is not None and size == self.size:
+            return np.unpackbits(self._bits)[:size].astype(bool)
+        mask = np.zeros(size, dtype=bool)
+        mask[self.indices] = True
+        return mask
+
+    def inRange(self, start, stop):
+        """Returns the active bits in [start, stop) as a sorted array."""
+        indices = self.indices
+        i, j = np.searchsorted(indices, (start, stop))
+        return indices[i:j]
+
+    def tolist(self):
+        # Convert through int64 so that Python 2 gives ints, not longs.
+        return self.indices.astype(np.int64).tolist()
+
+    def __len__(self):
+        return self.nActive
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __contains__(self, i):
+        if self._bits is not None:
+            if i < 0 or i >= self.size:
+                return False
+            return bool(self._bits[i >> 3] & (0x80 >> (i & 7)))
+        else:
+            j = np.searchsorted(self._indices, i)
+            return j < self.nActive and self._indices[j] == i
+
+    def __or__(self, other):
+        other = _asSDR(other)
+        return SDR(np.union1d(self.indices, other.indices),
+                   _resultSize(self, other))
+
+    def __and__(self, other):
+        other = _asSDR(other)
+        return SDR(np.intersect1d(self.indices, other.indices,
+                                  assume_unique=True),
+                   _resultSize(self, other))
+
+    def __sub__(self, other):
+        other = _asSDR(other)
+        return SDR(np.setdiff1d(self.indices, other.indices,
+                                assume_unique=True),
+                   _resultSize(self, other))
+
+    __ror__ = __or__
+    __rand__ = __and__
+
+    def __rsub__(self, other):
+        return _asSDR(other) - self
+
+    def __eq__(self, other):
+        if not isinstance(other, (SDR, set, frozenset)):
+            return NotImplemented
+        other = _asSDR(other)
+        return np.array_equal(self.indices, other.indices)
+
+    def __ne__(self, other):
+        ret = self.__eq__(other)
+        if ret is NotImplemented:
+            return ret
+        return not ret
+
+    __hash__ = None
+
+    # Pickle as raw index bytes, which is much smaller than pickling arrays.
+    def __getstate__(self):
+        return (self.size, self.indices.tobytes())
+
+    def __setstate__(self, state):
+        size, data = state
+        self.__init__(np.frombuffer(data, dtype=np.uint32), size)
+
+    def __repr__(self):
+        return "SDR(%s, size=%s)" % (self.tolist(), self.size)
+
+
+def _asSDR(v):
+    if isinstance(v, SDR):
+        return v
+    return SDR(v)
+
+
+def _resultSize(a, b):
+    if a.size is None and b.size is None:
+        return None
+    return max(_extent(a), _extent(b))
+
+
+def _extent(v):
+    """
+    The size of an SDR, or if it doesn't have one, the size needed to hold
+    its bits.
+    """
+    if v.size is not None:
+        return v.size
+    elif v.nActive > 0:
+        return int(v.indices[-1]) + 1
+    else:
+        return 0
+
+
+class ColumnIndex(object):
+    """
+    A layer's cells, grouped by column. The cells are a sorted array, and
+    offsets[col] is where the column's cells begin, so finding a column's
+    cells is a slice rather than a search.
+    """
+    def __init__(self, cells, cellsPerColumn, nColumns):
+        self.cells = _asSDR(cells).indices
+        self.cellsPerColumn = cellsPerColumn
+        self.offsets = np.searchsorted(
+            self.cells, np.arange(nColumns + 1) * cellsPerColumn)
+
+    @property
+    def nbytes(self):
+        return self.cells.nbytes + self.offsets.nbytes
+
+    def cellsInColumn(self, col):
+        """
+        Returns the column's cells, numbered within the column. A column
+        outside the layer has no cells.
+        """
+        if not 0 <= col < len(self.offsets) - 1:
+            return SDR((), self.cellsPerColumn)
+        cells = self.cells[self.offsets[col]:self.offsets[col + 1]]
+        return SDR(cells - col * self.cellsPerColumn, self.cellsPerColumn)
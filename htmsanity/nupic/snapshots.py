@@ -0,0 +1,488 @@
+import collections
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+from archive import SnapshotArchive
+from lazysegments import LazySegments
+from lru import LRUCache
+from sdr import SDR
+
+
+def estimateSize(obj, sampleSize=16):
+    """
+    Estimate the number of bytes of memory used by a snapshot or any part of
+    one.
+
+    Large collections are estimated from a sample of their elements, so this
+    is cheap enough to call on every appended snapshot.
+    """
+    if isinstance(obj, (np.ndarray, SDR, BitsDelta, LazySegments)):
+        return sys.getsizeof(obj) + obj.nbytes
+
+    nBytes = sys.getsizeof(obj)
+    if isinstance(obj, collections.Mapping):
+        items = obj.iteritems()
+        n = len(obj)
+        sample = [estimateSize(k, sampleSize) + estimateSize(v, sampleSize)
+                  for k, v in _take(items, sampleSize)]
+    elif isinstance(obj, (list, tuple, set, frozenset, collections.deque)):
+        n = len(obj)
+        sample = [estimateSize(v, sampleSize)
+                  for v in _take(iter(obj), sampleSize)]
+    else:
+        return nBytes
+
+    if len(sample) > 0:
+        nBytes += sum(sample) * n // len(sample)
+
+    return nBytes
+
+
+def _take(iterator, n):
+    for _ in xrange(n):
+        yield next(iterator)
+
+
+class SnapshotUnavailable(Exception):
+    """
+    Raised when a journal request refers to a snapshot that the journal can't
+    answer, e.g. because it has been evicted.
+    """
+    def __init__(self, snapshotId, reason):
+        super(SnapshotUnavailable, self).__init__(
+            "Snapshot %s is unavailable: %s" % (snapshotId, reason))
+        self.snapshotId = snapshotId
+        self.reason = reason
+
+
+class SnapshotRingBuffer(object):
+    """
+    Fixed-capacity storage for journal snapshots, keyed by snapshot id.
+
+    Snapshot ids are assigned sequentially and are never reused. When the
+    buffer is full, appending a snapshot evicts the oldest one, so the retained
+    snapshots always have ids firstSnapshotId through nextSnapshotId - 1.
+
+    Each snapshot is stored with an estimate of its size in bytes, so callers
+    can also evict by memory usage.
+
+    Subclasses can store snapshots in another form by overriding encode and
+    decode. The stored records must keep the snapshot's 'senses' / 'layers'
+    structure.
+    """
+    def __init__(self, capacity):
+        assert capacity > 0
+        self.capacity = capacity
+        self.slots = [None] * capacity
+        self.sizes = [0] * capacity
+        self.totalBytes = 0
+        self.firstSnapshotId = 0
+        self.nextSnapshotId = 0
+
+    def __len__(self):
+        return self.nextSnapshotId - self.firstSnapshotId
+
+    def __contains__(self, snapshotId):
+        return self.firstSnapshotId <= snapshotId < self.nextSnapshotId
+
+    def __getitem__(self, snapshotId):
+        self.checkAvailable(snapshotId)
+        return self.decode(snapshotId)
+
+    def checkAvailable(self, snapshotId):
+        if snapshotId < self.firstSnapshotId:
+            raise SnapshotUnavailable(snapshotId, 'evicted')
+        if snapshotId >= self.nextSnapshotId:
+            raise SnapshotUnavailable(snapshotId, 'unknown')
+
+    def encode(self, snapshotId, snapshot):
+        """Returns the record to store for a newly appended snapshot."""
+        return snapshot
+
+    def decode(self, snapshotId):
+        """Returns the snapshot for a stored record."""
+        return self.slots[snapshotId % self.capacity]
+
+    def append(self, snapshot):
+        if len(self) == self.capacity:
+            self.evictOldest()
+
+        snapshotId = self.nextSnapshotId
+        record = self.encode(snapshotId, snapshot)
+        nBytes = estimateSize(record)
+        i = snapshotId % self.capacity
+        self.slots[i] = record
+        self.sizes[i] = nBytes
+        self.totalBytes += nBytes
+        self.nextSnapshotId += 1
+        return snapshotId
+
+    def evictOldest(self):
+        assert len(self) > 0
+        snapshotId = self.firstSnapshotId
+        i = snapshotId % self.capacity
+        self.slots[i] = None
+        self.totalBytes -= self.sizes[i]
+        self.sizes[i] = 0
+        self.firstSnapshotId += 1
+        return snapshotId
+
+    def stripSegments(self, snapshotId, segmentsKey):
+        """
+        Remove segmentsKey from every layer of a stored snapshot.
+
+        Returns the estimated number of bytes freed.
+        """
+        self.checkAvailable(snapshotId)
+        i = snapshotId % self.capacity
+        nBytesRemoved = 0
+        for layerData in self.slots[i]['layers'].values():
+            if segmentsKey in layerData:
+                nBytesRemoved += estimateSize(layerData.pop(segmentsKey))
+
+        nBytesRemoved = min(nBytesRemoved, self.sizes[i])
+        self.sizes[i] -= nBytesRemoved
+        self.totalBytes -= nBytesRemoved
+        return nBytesRemoved
+
+    def getSize(self, snapshotId):
+        self.checkAvailable(snapshotId)
+        return self.sizes[snapshotId % self.capacity]
+
+    def setSize(self, snapshotId, nBytes):
+        self.checkAvailable(snapshotId)
+        i = snapshotId % self.capacity
+        self.totalBytes += nBytes - self.sizes[i]
+        self.sizes[i] = nBytes
+
+    def setCapacity(self, capacity):
+        assert capacity > 0
+        while len(self) > capacity:
+            self.evictOldest()
+
+        snapshotIds = range(self.firstSnapshotId, self.nextSnapshotId)
+        retained = [(self.slots[snapshotId % self.capacity],
+                     self.sizes[snapshotId % self.capacity])
+                    for snapshotId in snapshotIds]
+        self.capacity = capacity
+        self.slots = [None] * capacity
+        self.sizes = [0] * capacity
+        for snapshotId, (record, nBytes) in zip(snapshotIds, retained):
+            self.slots[snapshotId % capacity] = record
+            self.sizes[snapshotId % capacity] = nBytes
+
+    def hasSegments(self, snapshotId):
+        """
+        Whether the stored snapshot still has whatever segments it was
+        captured with.
+        """
+        return True
+
+    def keepsStrippedSegments(self, snapshotId):
+        """
+        Whether the snapshot's segments are still readable after
+        stripSegments, e.g. because they were also written to disk.
+        """
+        return False
+
+    def saveHeader(self, header):
+        """
+        Record a description of the journal, e.g. its network shape. Only
+        stores that persist their snapshots need it.
+        """
+        pass
+
+    def reversedSnapshots(self):
+        """
+        Iterate from the newest snapshot to the oldest.
+        """
+        for snapshotId in xrange(self.nextSnapshotId - 1,
+                                 self.firstSnapshotId - 1, -1):
+            yield self.decode(snapshotId)
+
+
+# The bit states that change a little on every timestep.
+DELTA_SENSE_KEYS = ('activeBits',)
+DELTA_LAYER_KEYS = ('activeCells', 'activeColumns',
+                    'predictiveCells', 'predictiveColumns',
+                    'predictedCells', 'predictedColumns')
+
+
+class BitsDelta(object):
+    """
+    The bits added and removed relative to the previous snapshot.
+    """
+    __slots__ = ('added', 'removed', 'size')
+
+    def __init__(self, prev, current):
+        prevIndices = prev.indices
+        indices = current.indices
+        self.added = np.setdiff1d(indices, prevIndices, assume_unique=True)
+        self.removed = np.setdiff1d(prevIndices, indices, assume_unique=True)
+        self.size = current.size
+
+    @property
+    def nbytes(self):
+        return self.added.nbytes + self.removed.nbytes
+
+    def apply(self, prev):
+        indices = np.setdiff1d(prev.indices, self.removed, assume_unique=True)
+        return SDR(np.union1d(indices, self.added), self.size)
+
+
+class DeltaSnapshotRingBuffer(SnapshotRingBuffer):
+    """
+    A SnapshotRingBuffer that stores bit states as deltas.
+
+    Every keyframeInterval snapshots, the bit states are stored in full. Other
+    snapshots store a BitsDelta per bit state. Reading a snapshot replays the
+    deltas since the most recent keyframe, and a small LRU cache keeps
+    recently read snapshots materialized.
+    """
+    def __init__(self, capacity, keyframeInterval=32, cacheSize=8):
+        super(DeltaSnapshotRingBuffer, self).__init__(capacity)
+        assert keyframeInterval > 0
+        self.keyframeInterval = keyframeInterval
+        self.materialized = LRUCache(cacheSize)
+        # The newest snapshot is always needed for the next delta.
+        self.newestSnapshot = None
+
+    def encode(self, snapshotId, snapshot):
+        prev = self.newestSnapshot
+        self.newestSnapshot = snapshot
+        if prev is None or snapshotId % self.keyframeInterval == 0:
+            return snapshot
+        return _deltaRecord(prev, snapshot)
+
+    def decode(self, snapshotId):
+        if snapshotId == self.nextSnapshotId - 1:
+            return self.newestSnapshot
+
+        snapshot = self.materialized.get(snapshotId)
+        if snapshot is not None:
+            return snapshot
+
+        # Replay from the nearest earlier snapshot that's available in full.
+        startId = snapshotId
+        while True:
+            record = self.slots[startId % self.capacity]
+            if _isKeyframe(record):
+                snapshot = record
+                break
+            cached = self.materialized.get(startId - 1)
+            if cached is not None:
+                snapshot = _applyDelta(cached, record)
+                break
+            startId -= 1
+
+        for i in xrange(startId + 1, snapshotId + 1):
+            snapshot = _applyDelta(snapshot, self.slots[i % self.capacity])
+
+        self.materialized.put(snapshotId, snapshot)
+        return snapshot
+
+    def evictOldest(self):
+        nextId = self.firstSnapshotId + 1
+        if nextId < self.nextSnapshotId:
+            i = nextId % self.capacity
+            if not _isKeyframe(self.slots[i]):
+                # The next snapshot becomes the oldest, so it must become a
+                # keyframe.
+                keyframe = self.decode(nextId)
+                self.slots[i] = keyframe
+                self.setSize(nextId, estimateSize(keyframe))
+
+        snapshotId = super(DeltaSnapshotRingBuffer, self).evictOldest()
+        self.materialized.pop(snapshotId)
+        if len(self) == 0:
+            self.newestSnapshot = None
+        return snapshotId
+
+    def stripSegments(self, snapshotId, segmentsKey):
+        nBytesRemoved = super(DeltaSnapshotRingBuffer, self).stripSegments(
+            snapshotId, segmentsKey)
+        self.materialized.pop(snapshotId)
+        if snapshotId == self.nextSnapshotId - 1:
+            for layerData in self.newestSnapshot['layers'].values():
+                layerData.pop(segmentsKey, None)
+        return nBytesRemoved
+
+
+def _deltaRecord(prev, snapshot):
+    record = dict(snapshot)
+    for group, keys in (('senses', DELTA_SENSE_KEYS),
+                        ('layers', DELTA_LAYER_KEYS)):
+        record[group] = {}
+        for name, data in snapshot[group].items():
+            prevData = prev[group].get(name, {})
+            data = dict(data)
+            for k in keys:
+                if k in data and k in prevData:
+                    data[k] = BitsDelta(prevData[k], data[k])
+            record[group][name] = data
+    return record
+
+
+def _applyDelta(prev, record):
+    snapshot = dict(record)
+    for group in ('senses', 'layers'):
+        snapshot[group] = {}
+        for name, data in record[group].items():
+            data = dict(data)
+            for k, v in data.items():
+                if isinstance(v, BitsDelta):
+                    data[k] = v.apply(prev[group][name][k])
+            snapshot[group][name] = data
+    return snapshot
+
+
+def _isKeyframe(record):
+    for group in ('senses', 'layers'):
+        for data in record[group].values():
+            for v in data.values():
+                if isinstance(v, BitsDelta):
+                    return False
+    return True
+
+
+SEGMENT_KEYS = ('proximalSegments', 'distalSegments', 'apicalSegments')
+
+
+class DiskSnapshotRingBuffer(SnapshotRingBuffer):
+    """
+    A SnapshotRingBuffer that keeps only a hot window of recent snapshots in
+    memory and writes every snapshot through to a SnapshotArchive on disk.
+
+    The ring buffer's capacity is the size of the hot window. Snapshots that
+    have left it stay available. They are read back from the memory-mapped
+    archive when requested, and a small LRU cache holds the ones read most
+    recently. Segments are only written to disk if spillSegments is True.
+    Otherwise they are available only while a snapshot is in the hot window.
+
+    Memory accounting (totalBytes, getSize) covers only the hot window.
+
+    With readOnly=True, an existing journal is opened for replay. Every
+    snapshot is cold, nothing can be appended, and the archive's header says
+    whether segments were spilled.
+    """
+    def __init__(self, capacity, directory, chunkBytes=64 * 1024 * 1024,
+                 spillSegments=False, cacheSize=8, readOnly=False):
+        super(DiskSnapshotRingBuffer, self).__init__(capacity)
+        self.archive = SnapshotArchive(directory, chunkBytes, readOnly)
+        if readOnly:
+            self.header = self.archive.readHeader()
+            storage = self.header['capture-options'].get('storage') or {}
+            spillSegments = storage.get('spill-segments?', False)
+            self.firstSnapshotId = len(self.archive)
+            self.nextSnapshotId = len(self.archive)
+        elif len(self.archive) > 0:
+            raise ValueError("%s already contains a journal" % directory)
+        self.spillSegments = spillSegments
+        self.coldSnapshots = LRUCache(cacheSize)
+
+    def __contains__(self, snapshotId):
+        return 0 <= snapshotId < self.nextSnapshotId
+
+    def checkAvailable(self, snapshotId):
+        if snapshotId < 0 or snapshotId >= self.nextSnapshotId:
+            raise SnapshotUnavailable(snapshotId, 'unknown')
+
+    def isHot(self, snapshotId):
+        return snapshotId >= self.firstSnapshotId
+
+    def encode(self, snapshotId, snapshot):
+        if self.spillSegments:
+            self.archive.append(snapshot)
+        else:
+            self.archive.append(withoutSegments(snapshot))
+        return snapshot
+
+    def decode(self, snapshotId):
+        if self.isHot(snapshotId):
+            return super(DiskSnapshotRingBuffer, self).decode(snapshotId)
+
+        snapshot = self.coldSnapshots.get(snapshotId)
+        if snapshot is None:
+            snapshot = self.archive[snapshotId]
+            self.coldSnapshots.put(snapshotId, snapshot)
+        return snapshot
+
+    def stripSegments(self, snapshotId, segmentsKey):
+        if not self.isHot(snapshotId):
+            return 0
+        return super(DiskSnapshotRingBuffer, self).stripSegments(snapshotId,
+                                                                 segmentsKey)
+
+    def getSize(self, snapshotId):
+        if not self.isHot(snapshotId):
+            return 0
+        return super(DiskSnapshotRingBuffer, self).getSize(snapshotId)
+
+    def setSize(self, snapshotId, nBytes):
+        if self.isHot(snapshotId):
+            super(DiskSnapshotRingBuffer, self).setSize(snapshotId, nBytes)
+
+    def hasSegments(self, snapshotId):
+        return self.isHot(snapshotId) or self.spillSegments
+
+    def keepsStrippedSegments(self, snapshotId):
+        # Stripping only affects the hot window. A cold snapshot is read
+        # from the archive, with its spilled segments.
+        return self.spillSegments and not self.isHot(snapshotId)
+
+    def saveHeader(self, header):
+        self.archive.writeHeader(header)
+
+
+def withoutSegments(snapshot):
+    ret = dict(snapshot)
+    ret['layers'] = {}
+    for lyrId, layerData in snapshot['layers'].items():
+        ret['layers'][lyrId] = dict((k, v) for k, v in layerData.items()
+                                    if k not in SEGMENT_KEYS)
+    return ret
+
+
+def makeSnapshotStore(captureOptions):
+    """
+    Create the snapshot storage described by the 'storage' capture option.
+
+    Example value:
+      {
+          # 'memory' (default), 'delta' or 'disk'
+          'mode': 'delta',
+          # 'delta' and 'disk'. Number of decoded snapshots to cache.
+          'cache-size': 8,
+          # 'delta' only
+          'keyframe-interval': 32,
+          # 'disk' only. The journal's 'keep-steps' is the number of recent
+          # snapshots kept in memory. Every snapshot is also written here,
+          # and the directory can be replayed later with runner.replay.
+          'directory': '/tmp/my-run', # Default: a new temporary directory
+          'chunk-bytes': 64 * 1024 * 1024,
+          'spill-segments?': False,
+      }
+    """
+    storage = captureOptions.get('storage') or {}
+    mode = storage.get('mode', 'memory')
+    keepSteps = captureOptions['keep-steps']
+    if mode == 'memory':
+        return SnapshotRingBuffer(keepSteps)
+    elif mode == 'delta':
+        return DeltaSnapshotRingBuffer(keepSteps,
+                                       storage.get('keyframe-interval', 32),
+                                       storage.get('cache-size', 8))
+    elif mode == 'disk':
+        directory = storage.get('directory')
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix='sanity-journal-')
+        return DiskSnapshotRingBuffer(keepSteps, os.path.expanduser(directory),
+                                      storage.get('chunk-bytes',
+                                                  64 * 1024 * 1024),
+                                      storage.get('spill-segments?', False),
+                                      storage.get('cache-size', 8))
+    else:
+        raise ValueError("Unrecognized storage mode: %s" % mode)
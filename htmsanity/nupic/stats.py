@@ -0,0 +1,140 @@
+import numpy as np
+
+from sdr import SDR
+
+# The statistics that get-layer-stats serves, in LayerStatsTable column order.
+LAYER_STATS = (
+    'n-unpredicted-active-columns',
+    'n-predicted-inactive-columns',
+    'n-predicted-active-columns',
+    'n-unpredicted-active-cells',
+    'n-predicted-inactive-cells',
+    'n-predicted-active-cells',
+)
+LAYER_STAT_INDEX = dict((k, i) for i, k in enumerate(LAYER_STATS))
+
+
+def getPredictedColumns(layerData, prevLayerData):
+    """
+    The columns that were predicted for this timestep. Some models provide
+    them directly, others provide the previous timestep's predictiveColumns.
+    """
+    return _getPredicted(layerData, prevLayerData, 'Columns')
+
+
+def getPredictedCells(layerData, prevLayerData):
+    return _getPredicted(layerData, prevLayerData, 'Cells')
+
+
+def _getPredicted(layerData, prevLayerData, suffix):
+    if 'predicted' + suffix in layerData:
+        return layerData['predicted' + suffix]
+    elif (prevLayerData is not None and
+          'predictive' + suffix in prevLayerData):
+        return prevLayerData['predictive' + suffix]
+    else:
+        return SDR()
+
+
+def computeLayerStats(modelData, prevModelData):
+    """
+    Compute every LAYER_STATS value for each layer of a snapshot. Returns a
+    dict of tuples, keyed by layer id.
+    """
+    ret = {}
+    for lyrId, layerData in modelData['layers'].items():
+        prevLayerData = None
+        if prevModelData is not None:
+            prevLayerData = prevModelData['layers'].get(lyrId)
+
+        activeColumns = layerData['activeColumns']
+        predictedColumns = getPredictedColumns(layerData, prevLayerData)
+        activeCells = layerData['activeCells']
+        predictedCells = getPredictedCells(layerData, prevLayerData)
+
+        ret[lyrId] = (
+            len(activeColumns - predictedColumns),
+            len(predictedColumns - activeColumns),
+            len(activeColumns & predictedColumns),
+            len(activeCells - predictedCells),
+            len(predictedCells - activeCells),
+            len(activeCells & predictedCells),
+        )
+    return ret
+
+
+class LayerStatsTable(object):
+    """
+    Per-snapshot layer statistics in a NumPy array indexed by snapshot id, so
+    that they can be served without revisiting the snapshots.
+
+    The statistics are tiny, so they're kept for every snapshot, even after
+    the snapshot itself is evicted.
+    """
+    def __init__(self, lyrIds, initialCapacity=1024):
+        self.lyrIndex = dict((lyrId, i)
+                             for i, lyrId in enumerate(sorted(lyrIds)))
+        self.values = np.zeros((initialCapacity, len(self.lyrIndex),
+                                len(LAYER_STATS)), dtype=np.uint32)
+        self.known = np.zeros(initialCapacity, dtype=bool)
+
+    def __contains__(self, snapshotId):
+        return 0 <= snapshotId < len(self.known) and self.known[snapshotId]
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + self.known.nbytes
+
+    def set(self, snapshotId, statsByLayer):
+        if snapshotId >= len(self.known):
+            capacity = max(snapshotId + 1, 2 * len(self.known))
+            values = np.zeros((capacity,) + self.values.shape[1:],
+                              dtype=self.values.dtype)
+            values[:len(self.values)] = self.values
+            known = np.zeros(capacity, dtype=bool)
+            known[:len(self.known)] = self.known
+            self.values = values
+            self.known = known
+
+        for lyrId, stats in statsByLayer.items():
+            self.values[snapshotId, self.lyrIndex[lyrId]] = stats
+        self.known[snapshotId] = True
+
+    def get(self, snapshotId, lyrId):
+        """Returns the layer's LAYER_STATS values for the snapshot."""
+        assert snapshotId in self
+        return self.values[snapshotId, self.lyrIndex[lyrId]]
+
+    def getRange(self, start, stop, lyrId):
+        """
+        Returns the layer's LAYER_STATS values for snapshots start through
+        stop - 1, one row per snapshot.
+        """
+        assert self.known[start:stop].all()
+        return self.values[start:stop, self.lyrIndex[lyrId]]
+
+
+def downsample(values, maxPoints):
+    """
+    Summarize the rows of values with at most maxPoints buckets of consecutive
+    rows.
+
+    Returns the index of each bucket's first row, and each bucket's min, max
+    and mean of every column. maxPoints must be at least 1, or None to keep
+    every row.
+    """
+    if maxPoints is not None and maxPoints < 1:
+        raise ValueError("maxPoints must be at least 1, not %s" % maxPoints)
+
+    nRows = len(values)
+    if maxPoints is None or nRows <= maxPoints:
+        starts = np.arange(nRows)
+        return starts, values, values, values.astype(np.float64)
+
+    starts = np.unique(np.linspace(0, nRows, maxPoints,
+                                   endpoint=False).astype(np.int64))
+    sizes = np.diff(np.append(starts, nRows))
+    mins = np.minimum.reduceat(values, starts)
+    maxes = np.maximum.reduceat(values, starts)
+    means = np.add.reduceat(values, starts, dtype=np.float64) / sizes[:, None]
+    return starts, mins, maxes, means
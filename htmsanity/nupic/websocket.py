@@ -3,11 +3,14 @@ import numpy
 from autobahn.twisted.websocket import WebSocketServerProtocol
 from transit.writer import Writer
 from transit.reader import Reader
-from transit.write_handlers import IntHandler, FloatHandler, ArrayHandler
+from transit.write_handlers import (IntHandler, FloatHandler, ArrayHandler,
+                                    SetHandler)
 from StringIO import StringIO
+import uuid
 from twisted.internet import reactor
 
 import marshalling as marshal
+from sdr import SDR
 
 class NumpyIntHandler(IntHandler):
     @staticmethod
@@ -24,13 +27,57 @@ class NumpyArrayHandler(ArrayHandler):
     def rep(a):
         return a.tolist()
 
+class SDRHandler(SetHandler):
+    @staticmethod
+    def rep(s):
+        return s.tolist()
+
+class NoCache(object):
+    """
+    A transit write cache that never caches, so a value's encoding doesn't
+    depend on the rest of the message.
+    """
+    @staticmethod
+    def encode(name, as_map_key=False):
+        return name
+
+class PreEncodedPlaceholderHandler(object):
+    """
+    Writes a placeholder string for each PreEncodedMarshal, remembering the
+    marshals so that their encodings can be spliced in afterward.
+    """
+    def __init__(self):
+        self.prefix = "pre-encoded-%s-" % uuid.uuid4().hex
+        self.marshals = []
+
+    @staticmethod
+    def tag(preEncodedMarshal):
+        return 's'
+
+    def rep(self, preEncodedMarshal):
+        self.marshals.append(preEncodedMarshal)
+        return self.prefix + str(len(self.marshals) - 1)
+
+    def string_rep(self, preEncodedMarshal):
+        return self.rep(preEncodedMarshal)
+
+def containsPreEncoded(v):
+    # PreEncodedMarshals are responses, or lists of responses, so don't look
+    # inside other values.
+    if isinstance(v, marshal.PreEncodedMarshal):
+        return True
+    elif isinstance(v, (list, tuple)):
+        return any(containsPreEncoded(v2) for v2 in v)
+    else:
+        return False
+
 TRANSIT_ENCODING = "json"
 
 # twisted wants a class, not an object. We need to give the object
 # parameters of our own. So we use a closure.
 def makeSanityWebSocketClass(localTargets, localResources, remoteResources):
     class SanityWebSocket(WebSocketServerProtocol):
-        def sanitySend(self, message):
+        def makeWriter(self, io, extraHandlers={}):
             writeHandlers = marshal.getWriteHandlers(localTargets, localResources)
             writeHandlers.update({
                 deque: ArrayHandler,
@@ -38,13 +85,44 @@ def makeSanityWebSocketClass(localTargets, localResources, remoteResources):
                 numpy.int64: NumpyIntHandler,
                 numpy.float32: NumpyFloatHandler,
                 numpy.ndarray: NumpyArrayHandler,
+                SDR: SDRHandler,
             })
-            io = StringIO()
+            writeHandlers.update(extraHandlers)
             writer = Writer(io, TRANSIT_ENCODING)
             for objType, handler in writeHandlers.items():
                 writer.register(objType, handler)
-            writer.write(message)
-            serialized = str(io.getvalue())
+            return writer
+
+        def encodeOnce(self, preEncodedMarshal):
+            if preEncodedMarshal.encoded is None:
+                io = StringIO()
+                writer = self.makeWriter(io)
+                writer.marshaler.marshal(preEncodedMarshal.value, False,
+                                         NoCache())
+                preEncodedMarshal.setEncoded(str(io.getvalue()))
+            return preEncodedMarshal.encoded
+
+        def sanitySend(self, message):
+            io = StringIO()
+            if containsPreEncoded(message):
+                # The pre-encoded values are written without a cache, so the
+                # rest of the message mustn't refer to cached strings either.
+                # Otherwise the reader's cache would get out of sync.
+                placeholders = PreEncodedPlaceholderHandler()
+                writer = self.makeWriter(io, {
+                    marshal.PreEncodedMarshal: placeholders,
+                })
+                writer.marshaler.marshal_top(message, NoCache())
+                serialized = str(io.getvalue())
+                for i, preEncodedMarshal in enumerate(placeholders.marshals):
+                    serialized = serialized.replace(
+                        '"%s%d"' % (placeholders.prefix, i),
+                        self.encodeOnce(preEncodedMarshal), 1)
+            else:
+                writer = self.makeWriter(io)
+                writer.write(message)
+                serialized = str(io.getvalue())
+
             reactor.callFromThread(WebSocketServerProtocol.sendMessage,
                                    self, serialized, isBinary=False)
 
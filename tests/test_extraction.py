@@ -0,0 +1,57 @@
+import unittest
+from StringIO import StringIO
+
+import numpy as np
+from transit.reader import Reader
+
+from htmsanity.nupic.extraction import ClassifiedSegments
+from htmsanity.nupic.websocket import makeSanityWebSocketClass
+
+
+def encode(value):
+    io = StringIO()
+    writer = makeSanityWebSocketClass({}, {}, {})().makeWriter(io)
+    writer.write(value)
+    return io.getvalue()
+
+
+class ClassifiedSegmentsTest(unittest.TestCase):
+    def setUp(self):
+        # Two segments on a 10-bit input and a 5-bit input.
+        self.classified = ClassifiedSegments(
+            2,
+            segmentIds=[0, 0, 0, 1, 1],
+            presynapticCells=[1, 4, 12, 3, 14],
+            permanences=np.array([0.6, 0.2, 0.7, 0.5, 0.1], dtype=np.float32),
+            connectedPermanence=0.5,
+            activeBits=[1, 3, 12],
+            onlyActiveSynapses=False,
+            onlyConnectedSynapses=False,
+            inputsAndWidths=[('this', 10), ('other', 5)])
+
+    def test_summaries(self):
+        summaries = self.classified.summaries(0, 2)
+        self.assertEqual(len(summaries), 2)
+        synapses = summaries[0]['synapses']
+        self.assertEqual([bit for bit, _ in synapses['this']['active']], [1])
+        self.assertEqual([bit for bit, _ in synapses['this']['disconnected']],
+                         [4])
+        self.assertEqual([bit for bit, _ in synapses['other']['active']], [2])
+        self.assertEqual(summaries[1]['nConnectedActive'], 1)
+        self.assertEqual(summaries[1]['nDisconnectedTotal'], 1)
+
+    def test_transit_encodes_source_bits_as_ints(self):
+        summaries = self.classified.summaries(0, 2)
+        encoded = encode(summaries)
+        # Python 2 longs are written as BigIntegers, tagged "~n".
+        self.assertNotIn('"~n', encoded)
+
+        decoded = Reader('json').read(StringIO(encoded))
+        synapses = decoded[0]['synapses']
+        for state in ('active', 'disconnected'):
+            for bit, _ in synapses['this'][state]:
+                self.assertIs(type(bit), int)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,334 @@
+import copy
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from nupic.bindings.algorithms import SpatialPooler, TemporalMemory
+
+from htmsanity.nupic import marshalling as marshal
+from htmsanity.nupic.archive import SnapshotArchive
+from htmsanity.nupic.journal import Journal
+from htmsanity.nupic.model import SPTMModel
+from htmsanity.nupic.sdr import SDR
+from htmsanity.nupic.snapshots import (DeltaSnapshotRingBuffer,
+                                       DiskSnapshotRingBuffer,
+                                       SnapshotRingBuffer,
+                                       SnapshotUnavailable)
+
+
+N_BITS = 64
+N_CELLS = 128
+
+
+def makeBits(snapshotId):
+    """The bit states of a synthetic snapshot, overlapping its neighbors'."""
+    rng = np.random.RandomState(snapshotId)
+    return {
+        'activeBits': SDR(rng.choice(N_BITS, 8, replace=False), N_BITS),
+        'activeCells': SDR(rng.choice(N_CELLS, 10, replace=False), N_CELLS),
+        'activeColumns': SDR(range(snapshotId % 8, snapshotId % 8 + 4),
+                             N_BITS),
+    }
+
+
+def makeSnapshot(snapshotId):
+    bits = makeBits(snapshotId)
+    return {
+        'senses': {
+            'input': {'activeBits': bits['activeBits']},
+        },
+        'layers': {
+            'layer': {
+                'activeCells': bits['activeCells'],
+                'activeColumns': bits['activeColumns'],
+                'distalSegments': {snapshotId % 8: {0: ['segment']}},
+            },
+        },
+        'step': {'snapshot-id': snapshotId},
+    }
+
+
+class SnapshotStoreTestCase(unittest.TestCase):
+    def assertSnapshot(self, store, snapshotId, withSegments=True):
+        snapshot = store[snapshotId]
+        bits = makeBits(snapshotId)
+        layerData = snapshot['layers']['layer']
+        self.assertEqual(snapshot['senses']['input']['activeBits'],
+                         bits['activeBits'])
+        self.assertEqual(layerData['activeCells'], bits['activeCells'])
+        self.assertEqual(layerData['activeColumns'], bits['activeColumns'])
+        self.assertEqual(snapshot['step']['snapshot-id'], snapshotId)
+        self.assertEqual('distalSegments' in layerData, withSegments)
+
+    def assertUnavailable(self, store, snapshotId, reason):
+        with self.assertRaises(SnapshotUnavailable) as cm:
+            store[snapshotId]
+        self.assertEqual(cm.exception.snapshotId, snapshotId)
+        self.assertEqual(cm.exception.reason, reason)
+
+
+class SnapshotRingBufferTest(SnapshotStoreTestCase):
+    def test_evicted_and_unknown(self):
+        store = SnapshotRingBuffer(4)
+        for snapshotId in xrange(10):
+            store.append(makeSnapshot(snapshotId))
+
+        self.assertEqual(store.firstSnapshotId, 6)
+        for snapshotId in xrange(6, 10):
+            self.assertSnapshot(store, snapshotId)
+        self.assertUnavailable(store, 5, 'evicted')
+        self.assertUnavailable(store, 10, 'unknown')
+
+    def test_set_capacity(self):
+        store = SnapshotRingBuffer(4)
+        for snapshotId in xrange(10):
+            store.append(makeSnapshot(snapshotId))
+
+        store.setCapacity(2)
+        self.assertUnavailable(store, 7, 'evicted')
+        store.setCapacity(5)
+        store.append(makeSnapshot(10))
+        for snapshotId in xrange(8, 11):
+            self.assertSnapshot(store, snapshotId)
+
+
+class DeltaSnapshotRingBufferTest(SnapshotStoreTestCase):
+    def test_round_trip_across_eviction(self):
+        store = DeltaSnapshotRingBuffer(6, keyframeInterval=4, cacheSize=2)
+        for snapshotId in xrange(20):
+            store.append(makeSnapshot(snapshotId))
+            # Read the oldest first, so each read replays deltas rather than
+            # hitting the cache.
+            for retainedId in xrange(store.firstSnapshotId,
+                                     store.nextSnapshotId):
+                self.assertSnapshot(store, retainedId)
+
+        self.assertUnavailable(store, 13, 'evicted')
+
+    def test_round_trip_after_strip_segments(self):
+        store = DeltaSnapshotRingBuffer(6, keyframeInterval=4, cacheSize=2)
+        for snapshotId in xrange(10):
+            store.append(makeSnapshot(snapshotId))
+
+        # A delta, a keyframe, and the newest snapshot.
+        stripped = (5, 8, 9)
+        totalBytes = store.totalBytes
+        for snapshotId in stripped:
+            self.assertGreater(store.stripSegments(snapshotId,
+                                                   'distalSegments'), 0)
+        self.assertLess(store.totalBytes, totalBytes)
+
+        for snapshotId in xrange(4, 10):
+            self.assertSnapshot(store, snapshotId,
+                                withSegments=snapshotId not in stripped)
+
+        # Evicting makes the stripped delta into a keyframe.
+        for snapshotId in xrange(10, 15):
+            store.append(makeSnapshot(snapshotId))
+        self.assertEqual(store.firstSnapshotId, 9)
+        for snapshotId in xrange(9, 15):
+            self.assertSnapshot(store, snapshotId,
+                                withSegments=snapshotId not in stripped)
+
+
+class DiskSnapshotRingBufferTest(SnapshotStoreTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='sanity-test-')
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            store.archive.close()
+        shutil.rmtree(self.directory)
+
+    def makeStore(self, *args, **kwargs):
+        store = DiskSnapshotRingBuffer(3, self.directory, *args, **kwargs)
+        self.stores.append(store)
+        return store
+
+    def record(self, spillSegments):
+        store = self.makeStore(chunkBytes=1024, spillSegments=spillSegments)
+        store.saveHeader({
+            'capture-options': {
+                'storage': {'mode': 'disk', 'spill-segments?': spillSegments},
+            },
+            'network-shape': {'senses': {}, 'layers': {}},
+        })
+        for snapshotId in xrange(10):
+            store.append(makeSnapshot(snapshotId))
+        return store
+
+    def test_cold_snapshots(self):
+        store = self.record(spillSegments=False)
+        self.assertEqual(store.firstSnapshotId, 7)
+        for snapshotId in xrange(10):
+            self.assertIn(snapshotId, store)
+            self.assertSnapshot(store, snapshotId,
+                                withSegments=snapshotId >= 7)
+            self.assertEqual(store.hasSegments(snapshotId), snapshotId >= 7)
+        self.assertUnavailable(store, -1, 'unknown')
+        self.assertUnavailable(store, 10, 'unknown')
+
+        # Stripping a cold snapshot is a no-op.
+        self.assertEqual(store.stripSegments(2, 'distalSegments'), 0)
+
+    def test_spilled_segments(self):
+        store = self.record(spillSegments=True)
+        for snapshotId in xrange(10):
+            self.assertSnapshot(store, snapshotId)
+            self.assertTrue(store.hasSegments(snapshotId))
+
+    def test_reload(self):
+        self.record(spillSegments=True)
+        # The small chunks roll over.
+        self.assertTrue(os.path.exists(os.path.join(self.directory,
+                                                    'chunk-000001')))
+
+        store = self.makeStore(readOnly=True)
+        self.assertEqual(store.header['network-shape'],
+                         {'senses': {}, 'layers': {}})
+        self.assertTrue(store.spillSegments)
+        self.assertEqual(store.firstSnapshotId, 10)
+        self.assertEqual(store.nextSnapshotId, 10)
+        for snapshotId in reversed(xrange(10)):
+            self.assertSnapshot(store, snapshotId)
+        self.assertUnavailable(store, 10, 'unknown')
+
+    def test_refuse_to_overwrite(self):
+        self.record(spillSegments=False)
+        with self.assertRaises(ValueError):
+            self.makeStore()
+
+    def test_archive_reload(self):
+        archive = SnapshotArchive(self.directory, chunkBytes=64)
+        records = [{'i': i, 'data': range(i)} for i in xrange(20)]
+        for i, record in enumerate(records):
+            self.assertEqual(archive.append(record), i)
+        archive.writeHeader({'name': 'test'})
+        archive.close()
+
+        archive = SnapshotArchive(self.directory, readOnly=True)
+        self.assertEqual(len(archive), 20)
+        self.assertEqual([archive[i] for i in xrange(20)], records)
+        self.assertEqual(archive.readHeader(),
+                         {'name': 'test', 'format-version': 1})
+        with self.assertRaises(IndexError):
+            archive[20]
+        archive.close()
+
+        # Appending resumes in the last chunk.
+        archive = SnapshotArchive(self.directory, chunkBytes=64)
+        self.assertEqual(archive.append({'i': 20}), 20)
+        self.assertEqual(archive[19], records[19])
+        self.assertEqual(archive[20], {'i': 20})
+        archive.close()
+
+
+class Collector(object):
+    def __init__(self):
+        self.values = []
+
+    def put(self, v):
+        self.values.append(v)
+
+
+class JournalAvailabilityTest(unittest.TestCase):
+    def setUp(self):
+        self.sp = SpatialPooler(inputDimensions=[100], columnDimensions=[64],
+                                potentialRadius=100,
+                                numActiveColumnsPerInhArea=5,
+                                globalInhibition=True, seed=1)
+        self.tm = TemporalMemory(columnDimensions=(64,), cellsPerColumn=4,
+                                 activationThreshold=3, minThreshold=2,
+                                 maxNewSynapseCount=4, seed=2)
+        self.model = SPTMModel(self.sp, self.tm)
+        self.journal = Journal(self.model)
+
+    def setCaptureOptions(self, keepSteps, distalKeepSteps):
+        options = copy.deepcopy(self.journal.captureOptions)
+        options['keep-steps'] = keepSteps
+        options['distal-synapses'].update({
+            'capture?': True,
+            'keep-steps': distalKeepSteps,
+        })
+        self.journal.handleMessage(['set-capture-options', options])
+
+    def step(self, i):
+        inputBits = np.zeros(100, dtype=np.uint32)
+        inputBits[(i % 5) * 20:(i % 5) * 20 + 10] = 1
+        activeColumns = np.zeros(64, dtype=np.uint32)
+        self.sp.compute(inputBits, True, activeColumns)
+        self.model.predictedCells = self.tm.getPredictiveCells()
+        self.tm.compute(np.flatnonzero(activeColumns), True)
+        self.model.activeInputs = np.flatnonzero(inputBits)
+        self.model.activeColumns = np.flatnonzero(activeColumns)
+        self.model.onStepped()
+
+    def request(self, *msg):
+        collector = Collector()
+        self.journal.handleMessage(list(msg) + [marshal.channel(collector)])
+        response, = collector.values
+        if isinstance(response, marshal.PreEncodedMarshal):
+            response = response.value
+        return response
+
+    def test_evicted_vs_compacted(self):
+        self.setCaptureOptions(keepSteps=8, distalKeepSteps=2)
+        for i in xrange(12):
+            self.step(i)
+
+        newestId = self.journal.journal.nextSnapshotId - 1
+        self.assertNotIn('unavailable',
+                         self.request('get-distal-segments', newestId,
+                                      'sp+tm', [0]))
+        self.assertEqual(
+            self.request('get-distal-segments', newestId - 4, 'sp+tm', [0]),
+            {'unavailable': 'compacted', 'snapshot-id': newestId - 4})
+        self.assertEqual(
+            self.request('get-distal-segments', 1, 'sp+tm', [0]),
+            {'unavailable': 'evicted', 'snapshot-id': 1})
+
+        # Compacted snapshots keep their bits.
+        self.assertIn('active-columns',
+                      self.request('get-layer-bits', newestId - 4, 'sp+tm',
+                                   ['active-columns'], None))
+
+    def checkDiskJournal(self, spillSegments):
+        directory = tempfile.mkdtemp(prefix='sanity-test-')
+        self.addCleanup(shutil.rmtree, directory)
+        options = copy.deepcopy(self.journal.captureOptions)
+        options['keep-steps'] = 4
+        options['storage'] = {
+            'mode': 'disk',
+            'directory': directory,
+            'spill-segments?': spillSegments,
+        }
+        options['distal-synapses'].update({
+            'capture?': True,
+            'keep-steps': 2,
+        })
+        self.journal = Journal(self.model, options)
+        self.addCleanup(self.journal.journal.archive.close)
+        for i in xrange(12):
+            self.step(i)
+
+        newestId = self.journal.journal.nextSnapshotId - 1
+        # In the hot window, but compacted.
+        self.assertEqual(
+            self.request('get-distal-segments', newestId - 2, 'sp+tm', [0]),
+            {'unavailable': 'compacted', 'snapshot-id': newestId - 2})
+        # Cold, and compacted before it left the hot window.
+        return self.request('get-distal-segments', 3, 'sp+tm', [0])
+
+    def test_cold_spilled_segments(self):
+        self.assertNotIn('unavailable', self.checkDiskJournal(True))
+
+    def test_cold_segments_without_spilling(self):
+        self.assertEqual(self.checkDiskJournal(False),
+                         {'unavailable': 'compacted', 'snapshot-id': 3})
+
+
+if __name__ == '__main__':
+    unittest.main()